@@ -3,15 +3,16 @@ import asyncio
 import logging
 import logging.handlers
 import discord
-import queue
 import inspect
 from discord import app_commands
 from discord.ext import commands
 from typing import List, Optional
 
-from src import api, db, loading, queuing
+from src import api, archiving, counting, db, loading, prompting, queuing, summarizing
+from src.database import AsyncDatabase
 
 TOKEN, CONFIG = loading.load_config("config.yaml")
+api.configure(CONFIG)
 
 
 def update_generation_params(new_config: dict):
@@ -35,16 +36,36 @@ handler = logging.handlers.RotatingFileHandler(
 )
 
 # start db
-conn, cursor = db.connect_to_db()
+database = AsyncDatabase(
+    CONFIG.get("database_path"),
+    CONFIG.get("database_pragmas"),
+    CONFIG.get("database_readers", 4),
+    CONFIG.get("message_buffer_size", 50),
+    CONFIG.get("message_flush_interval", 1.0),
+    CONFIG.get("archive_path"),
+    CONFIG.get("database_engine"),
+    CONFIG.get("database_dsn"),
+)
+
+
+class ChatBot(commands.Bot):
+    async def close(self):
+        # queued requests still need discord and the database, so they're seen to first
+        await dispatcher.drain(CONFIG.get("shutdown_drain_seconds", 30))
+        logging.info(f"Requests: {dispatcher.stats()}")
+        await api.shutdown()
+        await database.close()
+        await super().close()
+
 
 # Load Bot
 intents = discord.Intents.default()
 intents.message_content = True
-client = commands.Bot(command_prefix=".", intents=intents, help_command=None)
+client = ChatBot(command_prefix=".", intents=intents, help_command=None)
 client.remove_command("help")
 
 visible_characters = []
-request_queue = queue.Queue()
+dispatcher = queuing.RequestDispatcher()
 
 
 ###
@@ -53,27 +74,30 @@ request_queue = queue.Queue()
 # TODO: no actual filepath existing checking yet lol
 
 
-def load_all_characters_and_return_visible_ones(filepaths: List[dict], cursor: any):
+async def load_all_characters_and_return_visible_ones(
+    filepaths: List[dict], database: any
+):
     visible_characters = []
     for fp in filepaths:
         if isinstance(fp, dict):
-            charlist = loading.load_all_characters_in_filepath(
-                fp.get("filepath") if isinstance(fp, dict) else fp, cursor, logging
+            charlist = await loading.load_all_characters_in_filepath(
+                fp.get("filepath") if isinstance(fp, dict) else fp, database, logging
             )
             if fp.get("visible"):
                 visible_characters = visible_characters + charlist
         elif isinstance(fp, str):
-            charlist = loading.load_all_characters_in_filepath(
-                fp.get("filepath"), cursor, logging
+            charlist = await loading.load_all_characters_in_filepath(
+                fp.get("filepath"), database, logging
             )
             visible_characters.append(charlist)
     return visible_characters
 
 
-def refresh_characters(ctx, cursor):
-    ctx.bot.visible_characters = load_all_characters_and_return_visible_ones(
-        CONFIG.get("character_directories"), cursor
+async def refresh_characters(ctx):
+    ctx.bot.visible_characters = await load_all_characters_and_return_visible_ones(
+        CONFIG.get("character_directories"), database
     )
+    prompting.invalidate_compiled_prompts()
 
 
 async def send_long_message(channel, message_text):
@@ -95,37 +119,39 @@ async def send_long_message(channel, message_text):
 
 
 def check_number_of_messages_for_author_in_queue(message):
-    user = message.author.id
-    user_list_in_que = list(i.author_id for i in list(request_queue.queue))
-    logging.debug(user_list_in_que)
-    logging.debug(user_list_in_que.count(user))
-    return user_list_in_que.count(user)
-
-
-async def attend_chatbot_request(client):
-    while True:
-        if not request_queue.empty():
-            request = request_queue.get()
-            logging.debug(request)
-            # try:
-            await request.attend_request(cursor, conn, CONFIG, client)
-            # except Exception as e:
-            #     logging.info(f"Queued request went wrong, {e}")
-        else:
-            await asyncio.sleep(1)
+    message_count = dispatcher.count_requests_from_author(message.author.id)
+    logging.debug(message_count)
+    return message_count
+
+
+def is_idle():
+    # background jobs only run while the bot has had nothing to do for a while
+    return dispatcher.is_idle(CONFIG.get("summary_idle_seconds", 60))
 
 
 @client.event
 async def on_ready():
     # conn, cursor = db.connect_to_db()
-    db.setup_database(cursor, conn)
+    await database.setup_database()
     # setup default character
-    client.visible_characters = load_all_characters_and_return_visible_ones(
-        CONFIG.get("character_directories"), cursor
+    client.visible_characters = await load_all_characters_and_return_visible_ones(
+        CONFIG.get("character_directories"), database
     )
-    conn.commit()
+    await database.commit()
     await client.tree.sync()
-    asyncio.create_task(attend_chatbot_request(client))
+    api.start_background_tasks()
+    dispatcher.start(database, CONFIG, client)
+    dispatcher.start_worker(
+        "token_counter", counting.run_token_counter, database, CONFIG
+    )
+    if CONFIG.get("summarize_evicted_history"):
+        dispatcher.start_worker(
+            "summarizer", summarizing.run_summarizer, is_idle, database, CONFIG
+        )
+    if database.archive_path:
+        dispatcher.start_worker(
+            "archiver", archiving.run_archiver, is_idle, database, CONFIG
+        )
 
 
 @client.event
@@ -140,14 +166,14 @@ async def on_message(message):
         # conn, cursor = db.connect_to_db()
         try:
             # this one only registers if it doesn't exist
-            db.check_and_register_channel_in_database(
+            await database.check_and_register_channel_in_database(
                 message.channel.id,
                 message.guild.id if message.guild else None,
-                cursor,
                 ctx.message.channel.type == discord.ChannelType.private,
             )
+            await database.commit()
             if client.user.mentioned_in(message) or (
-                db.can_bot_speak_freely_in_current_room(message.channel.id, cursor)
+                await database.can_bot_speak_freely_in_current_room(message.channel.id)
             ):
                 number_of_messages_for_author = (
                     check_number_of_messages_for_author_in_queue(message)
@@ -167,10 +193,10 @@ async def on_message(message):
                         text,
                         False,
                     )
-                    request_queue.put(request)
+                    dispatcher.put(request)
                 # conn.close()
         except Exception as e:
-            conn.rollback()
+            await database.rollback()
             logging.error(f"Rolling back, error in chatbot generation: {e}")
 
 
@@ -209,7 +235,7 @@ async def hallucinate(ctx: discord.Interaction, message: str):
         sent_message = await ctx.send(f"**{message}**")
 
         # request = queuing.GenericGenerationRequest(ctx.channel.id, ctx.message.author.id, message, False, sent_message)
-        # request_queue.put(request)
+        # dispatcher.put(request)
         params = CONFIG.get("generate_params", {})
         params["auto_max_new_tokens"] = True
 
@@ -269,11 +295,11 @@ async def cont(
                 None,
                 True,
             )
-            request_queue.put(request)
-            conn.commit()
+            dispatcher.put(request)
+            await database.commit()
         # conn.close()
     except Exception as e:
-        conn.rollback()
+        await database.rollback()
         # conn.close()
         await ctx.send(
             embed=discord.Embed().from_dict(
@@ -312,15 +338,16 @@ async def activate(
     if negative_prompt:
         negative_prompt = negative_prompt.replace("\\n", "\n")
     # conn, cursor = db.connect_to_db()
-    db.check_and_register_channel_in_database(
+    await database.check_and_register_channel_in_database(
         ctx.message.channel.id,
         ctx.message.guild.id if ctx.message.guild else None,
-        cursor,
         ctx.message.channel.type == discord.ChannelType.private,
     )
-    conn.commit()
+    await database.commit()
     # check character exists
-    character_check = db.retrieve_character_information_by_filename(character, cursor)
+    character_check = await database.retrieve_character_information_by_filename(
+        character
+    )
     if len(character_check) > 0:
         request = queuing.ActivateRequest(
             channel_id=ctx.channel.id,
@@ -330,7 +357,8 @@ async def activate(
             scenario=scenario,
             negative_prompt=negative_prompt,
         )
-        request_queue.put(request)
+        dispatcher.put(request)
+        prompting.invalidate_compiled_prompts(character_check[0]["character_id"])
         await ctx.send(
             embed=discord.Embed().from_dict(
                 {
@@ -379,7 +407,7 @@ async def deactivate(
             "description": "Error: {{e}}",
         },
     )
-    request_queue.put(request)
+    dispatcher.put(request)
     await ctx.send(
         embed=discord.Embed().from_dict(
             {
@@ -402,12 +430,12 @@ async def scenario(
 ):
     if scenario:
         scenario = scenario.replace("\\n", "\n")
-    db.check_and_register_channel_in_database(
+    await database.check_and_register_channel_in_database(
         ctx.message.channel.id,
         ctx.message.guild.id if ctx.message.guild else None,
-        cursor,
         ctx.message.channel.type == discord.ChannelType.private,
     )
+    await database.commit()
     success_embed_title = (
         f"Added scenario to current room for the chatbot to take into account."
         if scenario
@@ -431,7 +459,8 @@ async def scenario(
             "description": "Error: {{e}}",
         },
     )
-    request_queue.put(request)
+    dispatcher.put(request)
+    prompting.invalidate_compiled_prompts()
     await ctx.send(
         embed=discord.Embed().from_dict(
             {
@@ -456,10 +485,10 @@ async def replyall(
     # conn, cursor = db.connect_to_db()
     # if ctx.bot.is_owner(ctx.message.author.id):
     try:
-        db.register_or_update_channel_in_database(
-            ctx.message.channel.id, ctx.guild.id, replyall, cursor
+        await database.register_or_update_channel_in_database(
+            ctx.message.channel.id, ctx.guild.id, replyall
         )
-        conn.commit()
+        await database.commit()
         embed_title = (
             f"{ctx.bot.user.display_name} will reply to all messages in this channel."
             if replyall
@@ -475,7 +504,7 @@ async def replyall(
             )
         )
     except Exception as e:
-        conn.rollback()
+        await database.rollback()
         # conn.close()
         await ctx.send(
             embed=discord.Embed().from_dict(
@@ -517,10 +546,10 @@ async def changemyname(
         success_embed_title = f"Reset chatbot nickname for {user_name}."
 
     # conn, cursor = db.connect_to_db()
-    db.register_or_update_user_in_database(
-        ctx.message.author.id, ctx.message.author.display_name, cursor
+    await database.register_or_update_user_in_database(
+        ctx.message.author.id, ctx.message.author.display_name
     )
-    conn.commit()
+    await database.commit()
     request = queuing.GenericDatabaseRequest(
         channel_id=ctx.channel.id,
         author_id=ctx.message.author.id,
@@ -539,7 +568,7 @@ async def changemyname(
             "description": "Error: {{e}}",
         },
     )
-    request_queue.put(request)
+    dispatcher.put(request)
     await ctx.send(
         embed=discord.Embed().from_dict(
             {
@@ -585,9 +614,10 @@ async def reset(
         clear_channel_scenario=clear_all_scenarios,
         clear_character_scenarios=clear_all_scenarios,
     )
-    request_queue.put(request)
+    dispatcher.put(request)
+    prompting.invalidate_compiled_prompts()
     if resend_greetings and not deactivate_all_characters:
-        chardata = db.get_active_character_data_per_room(ctx.channel.id, cursor)
+        chardata = await database.get_active_character_data_per_room(ctx.channel.id)
         for character in chardata:
             if character["greeting"]:
                 request = queuing.SaveAndSendMessageRequest(
@@ -597,7 +627,7 @@ async def reset(
                     character["greeting"],
                     display_author=True,
                 )
-                request_queue.put(request)
+                dispatcher.put(request)
         success_embed_description += "Active characters will resend greetings."
 
     await ctx.send(
@@ -615,8 +645,8 @@ async def reset(
 async def reload_characters(ctx: discord.Interaction):
     if ctx.bot.is_owner(ctx.message.author.id):
         try:
-            refresh_characters(ctx, cursor)
-            conn.commit()
+            await refresh_characters(ctx)
+            await database.commit()
             # conn.close()
             await ctx.send(
                 embed=discord.Embed().from_dict(
@@ -628,7 +658,7 @@ async def reload_characters(ctx: discord.Interaction):
                 ephemeral=True,
             )
         except Exception as e:
-            conn.rollback()
+            await database.rollback()
             # conn.close()
             await ctx.send(
                 embed=discord.Embed().from_dict(
@@ -656,13 +686,14 @@ async def reload_characters(ctx: discord.Interaction):
 async def channelinfo(ctx: discord.Interaction):
     # conn, cursor = db.connect_to_db()
     try:
-        db.check_and_register_channel_in_database(
+        await database.check_and_register_channel_in_database(
             ctx.message.channel.id,
             ctx.message.guild.id if ctx.message.guild else None,
-            cursor,
             ctx.message.channel.type == discord.ChannelType.private,
         )
-        chardata = db.get_active_character_data_per_room(ctx.message.channel.id, cursor)
+        chardata = await database.get_active_character_data_per_room(
+            ctx.message.channel.id
+        )
         if len(chardata) > 0:
             charstring = "The current character(s) are active in this channel:\n"
             for c in chardata:
@@ -676,7 +707,7 @@ async def channelinfo(ctx: discord.Interaction):
         else:
             charstring = "There are no characters active in this channel.\n"
 
-        namedata = db.get_nicknames_per_room(ctx.message.channel.id, cursor)
+        namedata = await database.get_nicknames_per_room(ctx.message.channel.id)
         if len(namedata) > 0:
             namestring = "\nIn this channel, this chatbot knows the following users as the following nicknames:\n"
             for n in namedata:
@@ -684,8 +715,8 @@ async def channelinfo(ctx: discord.Interaction):
         else:
             namestring = ""
 
-        roomdata = db.can_bot_speak_freely_in_current_room(
-            ctx.message.channel.id, cursor
+        roomdata = await database.can_bot_speak_freely_in_current_room(
+            ctx.message.channel.id
         )
         roomstring = (
             f"\n{ctx.bot.user.display_name} will reply to all messages in current channel\n"
@@ -693,14 +724,14 @@ async def channelinfo(ctx: discord.Interaction):
             else f"\n{ctx.bot.user.display_name} will only respond to messages with **@{ctx.bot.user.display_name}** and to messages replying to the bot's messages\n"
         )
 
-        scenario = db.get_scenario_from_current_room(ctx.message.channel.id, cursor)
+        scenario = await database.get_scenario_from_current_room(ctx.message.channel.id)
         scenariostring = (
             f'\nThe current scenario is "{scenario}"'
             if scenario
             else "\nThere is no current scenario for this channel"
         )
 
-        conn.commit()
+        await database.commit()
         # conn.close()
         await ctx.send(
             embed=discord.Embed().from_dict(
@@ -712,7 +743,7 @@ async def channelinfo(ctx: discord.Interaction):
             ephemeral=True,
         )
     except Exception as e:
-        conn.rollback()
+        await database.rollback()
         # conn.close()
         await ctx.send(
             embed=discord.Embed().from_dict(
@@ -1,21 +1,94 @@
 from __future__ import annotations
 from typing import Optional, List
+import asyncio
 import logging
-import requests
+import time
+import aiohttp
+from . import backends, caching, tokenizing
 
 # TODO: placeholder for if no model is loaded
 
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+MAX_CONNECTIONS = 8
+BATCH_TOKEN_COUNT = False
+TOKEN_COUNT_CACHE_PATH = None
+TOKENIZER_IDENTITY_REFRESH_SECONDS = 60
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
 
-def post_request(payload: dict, url: str):
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, json=payload)
-    return response.json()
+session: Optional[aiohttp.ClientSession] = None
+backend_pool = backends.create_backend_pool({})
+token_count_cache = caching.TokenCountCache()
+remote_tokenizer_identity = None
+remote_tokenizer_identity_checked_at = 0.0
+hedge_stats = {"hedges_fired": 0, "hedges_won": 0}
 
 
-def get_request(payload: dict, url: str):
-    headers = {"Content-Type": "application/json"}
-    response = requests.get(url, headers=headers, json=payload)
-    return response.json()
+def configure(config: dict):
+    global CONNECT_TIMEOUT, READ_TIMEOUT, MAX_CONNECTIONS, BATCH_TOKEN_COUNT
+    global TOKEN_COUNT_CACHE_PATH, token_count_cache, backend_pool
+    global HEDGE_REQUESTS, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES
+    backend_pool = backends.create_backend_pool(config)
+    HEDGE_REQUESTS = config.get("api_hedge_requests", False)
+    HEDGE_PERCENTILE = config.get("api_hedge_percentile", 95)
+    HEDGE_MIN_SAMPLES = config.get("api_hedge_min_samples", 20)
+    CONNECT_TIMEOUT = config.get("api_connect_timeout") or CONNECT_TIMEOUT
+    READ_TIMEOUT = config.get("api_read_timeout") or READ_TIMEOUT
+    MAX_CONNECTIONS = config.get("api_max_connections") or MAX_CONNECTIONS
+    BATCH_TOKEN_COUNT = config.get("api_batch_token_count", False)
+    tokenizing.load_tokenizer(
+        config.get("tokenizer_path"), config.get("tokenizer_add_special_tokens", True)
+    )
+    TOKEN_COUNT_CACHE_PATH = config.get("token_count_cache_path")
+    token_count_cache = caching.TokenCountCache(
+        config.get("token_count_cache_size", 50000)
+    )
+    token_count_cache.load(TOKEN_COUNT_CACHE_PATH)
+
+
+def get_session():
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            ),
+            headers={"Content-Type": "application/json"},
+        )
+    return session
+
+
+async def close_session():
+    global session
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
+
+
+def start_background_tasks():
+    backend_pool.start_health_checks(get_session)
+
+
+async def shutdown():
+    backend_pool.stop_health_checks()
+    logging.info(f"Backend stats: {backend_pool.stats()}")
+    logging.info(f"Hedged request stats: {hedge_stats}")
+    logging.info(f"Token count cache stats: {token_count_cache.stats()}")
+    token_count_cache.save(TOKEN_COUNT_CACHE_PATH)
+    await close_session()
+
+
+async def post_request(payload: dict, url: str):
+    async with get_session().post(url, json=payload) as response:
+        return await response.json()
+
+
+async def get_request(payload: dict, url: str):
+    async with get_session().get(url, json=payload) as response:
+        return await response.json()
 
 
 async def generate_text(
@@ -24,16 +97,177 @@ async def generate_text(
 ):
     try:
         payload = {"prompt": prompt, **generate_params}
-        response = post_request(payload, "http://127.0.0.1:5000/api/v1/generate")
+        if HEDGE_REQUESTS and len(backend_pool.healthy_backends()) > 1:
+            response = await generate_hedged(payload)
+        else:
+            response = await post_generation(backend_pool.choose(), payload)
     except Exception as e:
         logging.error(f"Error in request, have you loaded a model? {e}")
     return response.get("results")[0].get("text")
 
 
-def count_tokens(text: str):
+async def post_generation(backend: backends.Backend, payload: dict):
+    async with backend_pool.track(backend, busy_after_cancel=True):
+        return await post_request(payload, f"{backend.url}/api/v1/generate")
+
+
+async def generate_hedged(payload: dict):
+    primary_backend = backend_pool.choose()
+    primary_task = asyncio.create_task(post_generation(primary_backend, payload))
+    hedge_delay = backend_pool.latency_percentile(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    if hedge_delay is None:  # not enough history to know what slow looks like yet
+        return await primary_task
+
+    done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay)
+    hedge_backend = backend_pool.choose(exclude=[primary_backend])
+    if done or hedge_backend is None or not hedge_backend.healthy:
+        return await primary_task
+
+    hedge_stats["hedges_fired"] += 1
+    logging.debug(
+        f"Hedging slow request to {primary_backend.url} on {hedge_backend.url}"
+    )
+    hedge_task = asyncio.create_task(post_generation(hedge_backend, payload))
+    pending = {primary_task, hedge_task}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                # only the request here is dropped, the backend finishes it on its own,
+                # stop-stream would stop whatever it's generating, which could be another bot's
+                for losing_task in pending:
+                    losing_task.cancel()
+                if task is hedge_task:
+                    hedge_stats["hedges_won"] += 1
+                return task.result()
+    raise primary_task.exception()
+
+
+async def stream_text(
+    prompt: str,
+    generate_params: Optional[dict] = {},
+):
+    """Yields chunks of text as they are generated, using the webui's streaming api"""
+    payload = {"prompt": prompt, **generate_params}
+    backend = backend_pool.choose(needs_streaming=True)
+    if backend is None:
+        raise Exception("No backend with a streaming api configured.")
+    async with backend_pool.track(backend), get_session().ws_connect(
+        f"{backend.streaming_url}/api/v1/stream", receive_timeout=READ_TIMEOUT
+    ) as websocket:
+        await websocket.send_json(payload)
+        async for message in websocket:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                logging.error(f"Unexpected message from streaming api: {message}")
+                break
+            data = message.json()
+            if data.get("event") == "text_stream":
+                yield data.get("text", "")
+            elif data.get("event") == "stream_end":
+                break
+
+
+async def get_tokenizer_identity():
+    """Names the tokenizer counting tokens, None until a backend has said which model it has"""
+    global remote_tokenizer_identity, remote_tokenizer_identity_checked_at
+    if tokenizing.is_loaded():
+        return tokenizing.tokenizer_identity
+
+    now = time.monotonic()
+    if (
+        remote_tokenizer_identity is None
+        or now - remote_tokenizer_identity_checked_at
+        > TOKENIZER_IDENTITY_REFRESH_SECONDS
+    ):
+        # backends in the pool are assumed to have the same model loaded
+        backend = backend_pool.choose()
+        try:
+            response = await get_request({}, f"{backend.url}/api/v1/model")
+            model_name = response.get("result")
+        except Exception as e:
+            logging.error(f"Could not get loaded model name: {e}")
+            model_name = None
+        # a backend that's down hasn't changed model, the last name stays until one answers
+        if model_name is not None:
+            remote_tokenizer_identity = f"remote:{model_name}"
+            remote_tokenizer_identity_checked_at = now
+    return remote_tokenizer_identity
+
+
+async def count_tokens(text: str):
+    tokenizer_identity = await get_tokenizer_identity()
+    token_count = (
+        token_count_cache.get(text, tokenizer_identity)
+        if tokenizer_identity is not None
+        else None
+    )
+    if token_count is None:
+        token_count = (
+            tokenizing.count_tokens(text)
+            if tokenizing.is_loaded()
+            else await count_tokens_remotely(text)
+        )
+        if tokenizer_identity is not None:
+            token_count_cache.put(text, tokenizer_identity, token_count)
+    return token_count
+
+
+async def count_tokens_remotely(text: str):
     try:
         payload = {"prompt": text}
-        response = post_request(payload, "http://127.0.0.1:5000/api/v1/token-count")
+        backend = backend_pool.choose()
+        async with backend_pool.track(backend, record_latency=False):
+            response = await post_request(payload, f"{backend.url}/api/v1/token-count")
     except Exception as e:
         logging.error(f"Error in request, have you loaded a model? {e}")
+        raise
     return response.get("results")[0].get("tokens")
+
+
+async def count_tokens_many(texts: List[str]):
+    tokenizer_identity = await get_tokenizer_identity()
+    # without knowing the tokenizer nothing can be told apart in the cache
+    token_counts = [
+        token_count_cache.get(text, tokenizer_identity)
+        if tokenizer_identity is not None
+        else None
+        for text in texts
+    ]
+    uncounted_texts = list(
+        dict.fromkeys(text for text, count in zip(texts, token_counts) if count is None)
+    )
+    if uncounted_texts:
+        new_counts = dict(
+            zip(uncounted_texts, await count_uncached_tokens_many(uncounted_texts))
+        )
+        if tokenizer_identity is not None:
+            for text, token_count in new_counts.items():
+                token_count_cache.put(text, tokenizer_identity, token_count)
+        token_counts = [
+            new_counts[text] if count is None else count
+            for text, count in zip(texts, token_counts)
+        ]
+    return token_counts
+
+
+async def count_uncached_tokens_many(texts: List[str]):
+    if not texts:
+        return []
+    if tokenizing.is_loaded():
+        return [tokenizing.count_tokens(text) for text in texts]
+    if BATCH_TOKEN_COUNT:
+        try:
+            backend = backend_pool.choose()
+            async with backend_pool.track(backend, record_latency=False):
+                response = await post_request(
+                    {"prompts": texts}, f"{backend.url}/api/v1/token-count"
+                )
+            token_counts = [result.get("tokens") for result in response.get("results")]
+            if len(token_counts) == len(texts):
+                return token_counts
+            logging.error("Batch token count returned the wrong number of results")
+        except Exception as e:
+            logging.error(f"Error in batch token count request: {e}")
+
+    # otherwise send them all at once over the pooled connections
+    return list(await asyncio.gather(*(count_tokens_remotely(text) for text in texts)))
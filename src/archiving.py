@@ -0,0 +1,50 @@
+from __future__ import annotations
+import asyncio
+import logging
+
+
+async def archive_messages(database: any, config: dict, is_idle: any):
+    batch_size = config.get("archive_batch_size", 500)
+    moved = 0
+    while is_idle():
+        async with database.transaction():
+            count = await database.archive_messages(
+                config.get("archive_after_days", 90), batch_size
+            )
+        moved += count
+        if count < batch_size:
+            break
+        # let anything that's waiting on the database go between batches
+        await asyncio.sleep(0)
+    return moved
+
+
+async def compact_database(database: any, config: dict):
+    retention_days = config.get("archive_retention_days", 0)
+    async with database.transaction():
+        expired = (
+            await database.delete_expired_archived_messages(retention_days)
+            if retention_days > 0
+            else 0
+        )
+    pages = config.get("vacuum_pages", 1000)
+    async with database.transaction():
+        freed = await database.incremental_vacuum(pages)
+        freed += await database.incremental_vacuum(pages, schema="archive")
+    return expired, freed
+
+
+async def run_archiver(is_idle: any, database: any, config: dict):
+    while True:
+        await asyncio.sleep(config.get("archive_interval_seconds", 300))
+        if not is_idle():
+            continue
+        try:
+            moved = await archive_messages(database, config, is_idle)
+            expired, freed = await compact_database(database, config)
+            if moved or expired or freed:
+                logging.info(
+                    f"Archived {moved} messages, deleted {expired} expired ones and freed {freed} pages"
+                )
+        except Exception as e:
+            logging.error(f"Error archiving messages: {e}")
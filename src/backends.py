@@ -0,0 +1,209 @@
+from __future__ import annotations
+from typing import Optional, List
+from collections import deque
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import time
+
+
+class Backend:
+    def __init__(self, url: str, streaming_url: Optional[str] = None):
+        self.url = url.rstrip("/")
+        self.streaming_url = (streaming_url or "").rstrip("/") or None
+        self.healthy = True
+        self.outstanding_requests = 0
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.failed_requests = 0
+        self.latencies = deque(maxlen=200)
+
+    def record_latency(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def latency_percentile(self, percentile: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding_requests": self.outstanding_requests,
+            "total_requests": self.total_requests,
+            "failed_requests": self.failed_requests,
+            "average_latency": sum(self.latencies) / len(self.latencies)
+            if self.latencies
+            else None,
+            "p50_latency": self.latency_percentile(50),
+            "p95_latency": self.latency_percentile(95),
+        }
+
+
+class BackendPool:
+    """Sends each request to the healthy backend with the fewest requests in flight"""
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        health_check_interval: float = 30,
+        max_consecutive_failures: int = 3,
+    ):
+        if not backends:
+            raise Exception("No text generation backends configured.")
+        self.backends = backends
+        self.health_check_interval = health_check_interval
+        self.max_consecutive_failures = max_consecutive_failures
+        self.health_check_task = None
+
+    def choose(self, exclude: List[Backend] = [], needs_streaming: bool = False):
+        candidates = [
+            backend
+            for backend in self.backends
+            if backend not in exclude and (backend.streaming_url or not needs_streaming)
+        ]
+        # if everything looks dead, try anyway rather than failing outright
+        healthy_candidates = [backend for backend in candidates if backend.healthy]
+        candidates = healthy_candidates or candidates
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda backend: (
+                backend.outstanding_requests,
+                backend.latency_percentile(50) or 0,
+            ),
+        )
+
+    def latency_percentile(self, percentile: float, min_samples: int = 1):
+        latencies = sorted(
+            latency for backend in self.backends for latency in backend.latencies
+        )
+        if len(latencies) < max(min_samples, 1):
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+    def healthy_backends(self):
+        return [backend for backend in self.backends if backend.healthy]
+
+    @asynccontextmanager
+    async def track(
+        self,
+        backend: Backend,
+        record_latency: bool = True,
+        busy_after_cancel: bool = False,
+    ):
+        """Keeps count of requests in flight and how long they take"""
+        backend.outstanding_requests += 1
+        backend.total_requests += 1
+        start_time = time.monotonic()
+        release_delay = 0
+        try:
+            yield backend
+        except asyncio.CancelledError:
+            if busy_after_cancel:
+                # the backend carries on with a generation dropped here, so it stays counted until
+                # the slow end of how long one takes there, or for a typical one more if it's past that
+                elapsed = time.monotonic() - start_time
+                expected = backend.latency_percentile(95) or 0
+                release_delay = (
+                    expected - elapsed
+                    if elapsed < expected
+                    else backend.latency_percentile(50) or 0
+                )
+            raise
+        except Exception:
+            backend.failed_requests += 1
+            backend.consecutive_failures += 1
+            if (
+                backend.healthy
+                and backend.consecutive_failures >= self.max_consecutive_failures
+            ):
+                backend.healthy = False
+                logging.warning(f"Backend {backend.url} is failing, ejecting it")
+            raise
+        else:
+            backend.consecutive_failures = 0
+            if record_latency:
+                backend.record_latency(time.monotonic() - start_time)
+        finally:
+            if release_delay > 0:
+                asyncio.get_running_loop().call_later(
+                    release_delay, self.release, backend
+                )
+            else:
+                self.release(backend)
+
+    def release(self, backend: Backend):
+        backend.outstanding_requests -= 1
+
+    async def check_health(self, session: any):
+        for backend in self.backends:
+            try:
+                async with session.get(f"{backend.url}/api/v1/model") as response:
+                    data = await response.json()
+                    is_healthy = response.status == 200 and data.get("result") not in (
+                        None,
+                        "None",
+                    )
+            except Exception:
+                is_healthy = False
+
+            if is_healthy and not backend.healthy:
+                logging.info(f"Backend {backend.url} is back, readmitting it")
+                backend.consecutive_failures = 0
+            elif not is_healthy and backend.healthy:
+                logging.warning(
+                    f"Backend {backend.url} failed health check, ejecting it"
+                )
+            backend.healthy = is_healthy
+
+    async def run_health_checks(self, get_session: any):
+        while True:
+            try:
+                await self.check_health(get_session())
+                logging.debug(self.stats())
+            except Exception as e:
+                logging.error(f"Error checking backend health: {e}")
+            await asyncio.sleep(self.health_check_interval)
+
+    def start_health_checks(self, get_session: any):
+        if self.health_check_task is None or self.health_check_task.done():
+            self.health_check_task = asyncio.create_task(
+                self.run_health_checks(get_session)
+            )
+
+    def stop_health_checks(self):
+        if self.health_check_task is not None:
+            self.health_check_task.cancel()
+            self.health_check_task = None
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+
+def create_backend_pool(config: dict):
+    backends = []
+    for backend_config in config.get("api_backends") or []:
+        if isinstance(backend_config, str):
+            backends.append(Backend(backend_config))
+        else:
+            backends.append(
+                Backend(backend_config.get("url"), backend_config.get("streaming_url"))
+            )
+    if not backends:
+        backends.append(
+            Backend(
+                config.get("api_url") or "http://127.0.0.1:5000",
+                config.get("streaming_api_url") or "ws://127.0.0.1:5005",
+            )
+        )
+    return BackendPool(
+        backends,
+        config.get("api_health_check_interval", 30),
+        config.get("api_max_consecutive_failures", 3),
+    )
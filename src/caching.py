@@ -0,0 +1,166 @@
+from __future__ import annotations
+from typing import Optional
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+class TokenCountCache:
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text: str, tokenizer_identity: str):
+        # hashing keeps every entry the same size no matter how long the text is
+        return hashlib.blake2b(
+            f"{tokenizer_identity}\0{text}".encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+    def get(self, text: str, tokenizer_identity: str):
+        key = self.make_key(text, tokenizer_identity)
+        token_count = self.entries.get(key)
+        if token_count is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return token_count
+
+    def put(self, text: str, tokenizer_identity: str, token_count: int):
+        if token_count is None or self.max_entries <= 0:
+            return
+        key = self.make_key(text, tokenizer_identity)
+        self.entries[key] = token_count
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def save(self, filepath: Optional[str]):
+        if not filepath:
+            return
+        try:
+            with open(filepath, "w", encoding="utf-8") as f:
+                json.dump(list(self.entries.items()), f)
+        except Exception as e:
+            logging.error(f"Could not save token count cache to {filepath}: {e}")
+
+    def load(self, filepath: Optional[str]):
+        if not filepath or not os.path.exists(filepath) or self.max_entries <= 0:
+            return
+        try:
+            with open(filepath, "r", encoding="utf-8") as f:
+                for key, token_count in json.load(f)[-self.max_entries :]:
+                    self.entries[key] = token_count
+            logging.info(f"Loaded {len(self.entries)} cached token counts")
+        except Exception as e:
+            logging.error(f"Could not load token count cache from {filepath}: {e}")
+
+
+class MetadataCache:
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.version = 0
+        # entries changed since the last commit, the reader connections can't see those writes yet
+        self.uncommitted_puts = set()
+        self.uncommitted_invalidations = set()
+        self.hits = 0
+        self.misses = 0
+        # off when other processes write to the same database
+        self.enabled = True
+
+    def get_or_load(self, table: str, key: any, load: any):
+        if not self.enabled:
+            return load()
+        with self.lock:
+            entries = self.tables.setdefault(table, {})
+            if key in entries:
+                self.hits += 1
+                value = entries[key]
+                return list(value) if isinstance(value, list) else value
+            self.misses += 1
+            version = self.version
+        value = load()
+        with self.lock:
+            # reads run on several threads, one that started before a write mustn't store what it found
+            if self.version == version:
+                self.tables[table][key] = value
+        return list(value) if isinstance(value, list) else value
+
+    def get(self, table: str, key: any, default: any = None):
+        if not self.enabled:
+            return default
+        with self.lock:
+            return self.tables.get(table, {}).get(key, default)
+
+    def put(self, table: str, key: any, value: any):
+        with self.lock:
+            self.version += 1
+            self.tables.setdefault(table, {})[key] = value
+            self.uncommitted_puts.add((table, key))
+
+    def invalidate(self, table: str, key: any = None):
+        with self.lock:
+            self.version += 1
+            self.drop_entry(table, key)
+            self.uncommitted_invalidations.add((table, key))
+
+    def drop_entry(self, table: str, key: any):
+        if key is None:
+            self.tables.pop(table, None)
+        else:
+            self.tables.get(table, {}).pop(key, None)
+
+    def committed(self):
+        # a reader may have cached what it saw between an invalidation and the commit
+        with self.lock:
+            self.version += 1
+            for table, key in self.uncommitted_invalidations:
+                self.drop_entry(table, key)
+            self.uncommitted_invalidations.clear()
+            self.uncommitted_puts.clear()
+
+    def rolled_back(self):
+        with self.lock:
+            self.version += 1
+            for table, key in self.uncommitted_invalidations | self.uncommitted_puts:
+                self.drop_entry(table, key)
+            self.uncommitted_invalidations.clear()
+            self.uncommitted_puts.clear()
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.tables.clear()
+            self.uncommitted_invalidations.clear()
+            self.uncommitted_puts.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": sum(len(entries) for entries in self.tables.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,70 @@
+from __future__ import annotations
+from typing import Optional, List
+from collections import OrderedDict
+
+MAX_MESSAGES_PER_WINDOW = 200
+MAX_WINDOWS = 1000
+
+
+class ConversationWindow:
+    def __init__(self, channel_id: int, messages: List[dict]):
+        self.channel_id = channel_id
+        self.messages = messages[-MAX_MESSAGES_PER_WINDOW:]
+
+    def append(self, message_id: Optional[int], author: str, message_content: str):
+        self.messages.append(
+            {
+                "message_id": message_id,
+                "author": author,
+                "message_content": message_content,
+                "token_count": None,
+                "tokenizer_identity": None,
+            }
+        )
+        if len(self.messages) > MAX_MESSAGES_PER_WINDOW:
+            del self.messages[: len(self.messages) - MAX_MESSAGES_PER_WINDOW]
+
+
+# channel id -> window, least recently used first
+windows = OrderedDict()
+
+
+async def get_window(channel_id: int, database: any):
+    window = windows.get(channel_id)
+    if window is None:
+        message_history = await database.get_message_history_from_channel(channel_id)
+        # another request may have loaded it while the history was being read
+        window = windows.get(channel_id) or ConversationWindow(
+            channel_id, [dict(message) for message in message_history]
+        )
+        windows[channel_id] = window
+        while len(windows) > MAX_WINDOWS:
+            windows.popitem(last=False)
+    windows.move_to_end(channel_id)
+    return window
+
+
+def record_message(
+    channel_id: int, message_id: Optional[int], author: str, message_content: str
+):
+    """Adds a newly saved message to the channel's window, if the channel has one loaded"""
+    window = windows.get(channel_id)
+    if window is not None:
+        window.append(message_id, author, message_content)
+
+
+def record_token_counts(channel_id: int, token_counts: dict, tokenizer_identity: str):
+    window = windows.get(channel_id)
+    if window is None:
+        return
+    for message in window.messages:
+        if message["message_id"] in token_counts:
+            message["token_count"] = token_counts[message["message_id"]]
+            message["tokenizer_identity"] = tokenizer_identity
+
+
+def forget_window(channel_id: Optional[int] = None):
+    if channel_id is None:
+        windows.clear()
+    else:
+        windows.pop(channel_id, None)
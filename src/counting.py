@@ -0,0 +1,49 @@
+from __future__ import annotations
+import asyncio
+import logging
+from . import api, conversation
+
+
+async def count_message_tokens(database: any, config: dict):
+    tokenizer_identity = await api.get_tokenizer_identity()
+    if tokenizer_identity is None:
+        # the backend hasn't said which model it has yet, try again later
+        return 0
+    messages = await database.get_messages_to_count(
+        tokenizer_identity, config.get("token_count_batch_size", 100)
+    )
+    if not messages:
+        return 0
+    # the same text save_message used to count, so stored counts mean the same thing
+    token_counts = await api.count_tokens_many(
+        [f"{message['author']}: {message['message_content']}" for message in messages]
+    )
+    counts_per_channel = {}
+    for message, token_count in zip(messages, token_counts):
+        counts_per_channel.setdefault(message["channel_id"], {})[
+            message["message_id"]
+        ] = token_count
+    async with database.transaction():
+        await database.save_message_token_counts(
+            {
+                message_id: token_count
+                for counts in counts_per_channel.values()
+                for message_id, token_count in counts.items()
+            },
+            tokenizer_identity,
+        )
+    for channel_id, counts in counts_per_channel.items():
+        conversation.record_token_counts(channel_id, counts, tokenizer_identity)
+    return len(messages)
+
+
+async def run_token_counter(database: any, config: dict):
+    while True:
+        try:
+            counted = await count_message_tokens(database, config)
+        except Exception as e:
+            logging.error(f"Error counting message tokens: {e}")
+            counted = 0
+        # a full batch means there are probably more waiting
+        if counted < config.get("token_count_batch_size", 100):
+            await asyncio.sleep(config.get("token_count_interval", 5))
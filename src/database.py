@@ -0,0 +1,370 @@
+from __future__ import annotations
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from . import conversation, db, storage
+
+# db functions that only read, these can go to any reader connection
+READ_FUNCTIONS = {
+    "check_existence_of_unique_record",
+    "check_existence_of_unique_record_with_two_fields",
+    "retrieve_character_information_by_name",
+    "retrieve_character_information_by_filename",
+    "lookup_nickname",
+    "can_bot_speak_freely_in_current_room",
+    "get_scenario_from_current_room",
+    "get_nicknames_per_room",
+    "get_active_character_data_per_room",
+    "get_active_character_count_per_room",
+    "get_message_history_from_channel",
+    "get_message_history_with_channel_before_specific_message_id",
+    "get_summary_for_channel",
+    "get_unsummarized_messages_from_channel",
+    "get_messages_to_count",
+}
+
+# set while the current task has written something it hasn't committed yet,
+# readers can't see uncommitted rows so until then its reads go to the writer
+has_uncommitted_writes = contextvars.ContextVar("has_uncommitted_writes", default=False)
+
+
+def insert_cursor_argument(function: any, args: tuple, kwargs: dict, cursor: any):
+    parameters = list(inspect.signature(function).parameters)
+    cursor_index = parameters.index("cursor")
+    if len(args) >= cursor_index:
+        return args[:cursor_index] + (cursor,) + args[cursor_index:], kwargs
+    return args, {**kwargs, "cursor": cursor}
+
+
+class DatabaseConnection:
+    def __init__(self, storage: any, read_only: bool = False):
+        self.storage = storage
+        self.read_only = read_only
+        self.executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="database-reader" if read_only else "database-writer",
+        )
+        self.conn = None
+        self.cursor = None
+
+    async def run(self, function: any, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs)
+        )
+
+    def open_connection(self):
+        self.conn = self.storage.connect(self.read_only)
+        self.cursor = self.conn.cursor()
+
+    async def connect(self):
+        if self.conn is None:
+            await self.run(self.open_connection)
+
+    async def call(self, function: any, *args, **kwargs):
+        await self.connect()
+
+        def call_with_cursor():
+            call_args, call_kwargs = insert_cursor_argument(
+                function, args, kwargs, self.cursor
+            )
+            return function(*call_args, **call_kwargs)
+
+        return await self.run(call_with_cursor)
+
+    async def commit(self):
+        await self.connect()
+        await self.run(self.conn.commit)
+
+    async def rollback(self):
+        await self.connect()
+        await self.run(self.conn.rollback)
+
+    async def close(self):
+        if self.conn is not None:
+            if not self.read_only:
+                await self.run(self.conn.commit)
+            await self.run(self.conn.close)
+            self.conn = None
+        self.executor.shutdown(wait=True)
+
+
+class AsyncDatabase:
+    """Runs the db functions off the event loop, writes in order on one connection and reads in parallel on the others"""
+
+    def __init__(
+        self,
+        filepath: str = "bot.db",
+        pragmas: Optional[dict] = None,
+        reader_count: int = 4,
+        message_buffer_size: int = 50,
+        message_flush_interval: float = 1.0,
+        archive_path: Optional[str] = None,
+        engine: Optional[str] = "sqlite",
+        dsn: Optional[str] = None,
+    ):
+        self.storage = storage.create_storage(engine, filepath, pragmas, dsn)
+        self.writer = DatabaseConnection(self.storage)
+        if not self.storage.supports_readers:
+            reader_count = 0
+        self.readers = [
+            DatabaseConnection(self.storage, read_only=True)
+            for _ in range(reader_count)
+        ]
+        self.idle_readers = asyncio.Queue()
+        for reader in self.readers:
+            self.idle_readers.put_nowait(reader)
+        # messages are written in batches, a flush interval of 0 writes each one straight away
+        self.message_buffer_size = message_buffer_size
+        self.message_flush_interval = message_flush_interval
+        if self.storage.shared:
+            # ids handed out here could also be handed out by another bot, so the database numbers each message
+            self.message_flush_interval = 0
+            # and what another bot writes wouldn't show up in this one's cache
+            db.metadata_cache.enabled = False
+        self.message_buffer = []
+        self.next_message_id = None
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        # how many buffered messages are written but not committed yet, they leave the buffer on commit
+        self.written_message_count = 0
+        # every task writes on the one writer connection, so only one at a time has a transaction open on it
+        self.transaction_lock = asyncio.Lock()
+        self.transaction_owner = None
+        # only the writer attaches the archive, nothing reads history from it
+        self.archive_path = archive_path if self.storage.supports_archive else None
+
+    @asynccontextmanager
+    async def reader(self):
+        if not self.readers or has_uncommitted_writes.get():
+            yield self.writer
+            return
+        reader = await self.idle_readers.get()
+        try:
+            yield reader
+        finally:
+            self.idle_readers.put_nowait(reader)
+
+    async def read(self, function: any, *args, **kwargs):
+        async with self.reader() as reader:
+            return await reader.call(function, *args, **kwargs)
+
+    async def write(self, function: any, *args, **kwargs):
+        await self.begin()
+        has_uncommitted_writes.set(True)
+        return await self.writer.call(function, *args, **kwargs)
+
+    async def call(self, function: any, *args, **kwargs):
+        if function.__name__ in READ_FUNCTIONS:
+            return await self.read(function, *args, **kwargs)
+        return await self.write(function, *args, **kwargs)
+
+    def __getattr__(self, name: str):
+        # awaitable versions of everything in db that takes a cursor
+        function = getattr(db, name, None)
+        if (
+            not callable(function)
+            or "cursor" not in inspect.signature(function).parameters
+        ):
+            raise AttributeError(name)
+        return functools.partial(self.call, function)
+
+    async def begin(self):
+        task = asyncio.current_task()
+        if self.transaction_owner is task:
+            return
+        owner = self.transaction_owner
+        if owner is not None and owner.done():
+            # a task that ended without committing would otherwise keep everyone else waiting
+            logging.warning(
+                f"Rolling back writes left uncommitted by {owner.get_name()}"
+            )
+            self.transaction_owner = None
+            await self.writer.rollback()
+            self.end_transaction(committed=False)
+        await self.transaction_lock.acquire()
+        self.transaction_owner = task
+
+    def end_transaction(self, committed: bool):
+        if committed:
+            del self.message_buffer[: self.written_message_count]
+            db.metadata_cache.committed()
+        else:
+            db.metadata_cache.rolled_back()
+        self.written_message_count = 0
+        self.transaction_owner = None
+        self.transaction_lock.release()
+
+    async def commit(self):
+        # a task without a transaction open has nothing of its own to commit, and mustn't commit someone else's
+        if self.transaction_owner is asyncio.current_task():
+            await self.writer.commit()
+            self.end_transaction(committed=True)
+        has_uncommitted_writes.set(False)
+
+    async def rollback(self):
+        if self.transaction_owner is asyncio.current_task():
+            await self.writer.rollback()
+            self.end_transaction(committed=False)
+        has_uncommitted_writes.set(False)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Commits what the task writes inside it or rolls it back on an error, joining the task's open transaction if it has one"""
+        joined = self.transaction_owner is asyncio.current_task()
+        try:
+            yield
+        except BaseException:
+            if not joined:
+                await self.rollback()
+            raise
+        if not joined:
+            await self.commit()
+
+    async def setup_database(self):
+        await self.writer.connect()
+        # this runs again on a reconnect, when a request could be halfway through a transaction
+        async with self.transaction():
+            await self.begin()
+            await self.writer.run(
+                db.setup_database, self.writer.cursor, self.writer.conn
+            )
+            if self.archive_path:
+                await self.writer.call(db.attach_archive, self.archive_path)
+        description = await self.writer.run(self.storage.describe, self.writer.conn)
+        logging.info(f"Opened {description} with {len(self.readers)} readers")
+
+    async def save_message(
+        self,
+        message: str,
+        author: str,
+        channel_id: int,
+        message_id: Optional[int],
+    ):
+        # saved without a token count, counting.py fills it in so nothing waits on the tokenizer here
+        if self.message_flush_interval > 0:
+            row_id = await self.buffer_message(message, author, channel_id, message_id)
+        else:
+            row_id = await self.write(
+                db.save_message, message, author, channel_id, message_id
+            )
+        conversation.record_message(channel_id, row_id, author, message)
+        return row_id is not None
+
+    async def buffer_message(
+        self,
+        message: str,
+        author: str,
+        channel_id: int,
+        message_id: Optional[int],
+    ):
+        """Queues a message to be written along with others in one transaction, returns the id it will be stored under"""
+        # an unregistered channel should fail here, not later for the whole batch
+        await self.writer.call(db.get_room_id, channel_id)
+        if self.next_message_id is None:
+            async with self.flush_lock:
+                if self.next_message_id is None:
+                    self.next_message_id = await self.writer.call(
+                        db.get_next_message_id
+                    )
+        row_id = self.next_message_id
+        self.next_message_id += 1
+        self.message_buffer.append(
+            {
+                "message_id": row_id,
+                "discord_id": message_id,
+                "channel_id": channel_id,
+                "author": author,
+                "message_content": message,
+                "token_count": None,
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+            }
+        )
+        if len(self.message_buffer) >= self.message_buffer_size:
+            await self.flush_messages()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_messages_later())
+        return row_id
+
+    async def flush_messages_later(self):
+        await asyncio.sleep(self.message_flush_interval)
+        self.flush_task = None
+        try:
+            await self.flush_messages()
+        except Exception as e:
+            logging.error(f"Error writing buffered messages: {e}")
+
+    async def flush_messages(self):
+        async with self.transaction():
+            await self.begin()
+            # only dropped once committed, so reads in the meantime still find them here
+            batch = self.message_buffer[self.written_message_count :]
+            if batch:
+                await self.write(db.save_messages, batch)
+                self.written_message_count += len(batch)
+                logging.debug(f"Wrote {len(batch)} buffered messages")
+        return len(batch)
+
+    async def get_message_history_from_channel(self, channel_id: int):
+        history = await self.read(db.get_message_history_from_channel, channel_id)
+        stored_message_ids = set(message["message_id"] for message in history)
+        buffered_messages = [
+            {
+                "message_id": message["message_id"],
+                "message_content": message["message_content"],
+                "author": message["author"],
+                "token_count": None,
+                "tokenizer_identity": None,
+            }
+            for message in self.message_buffer
+            if message["channel_id"] == channel_id
+            and message["message_id"] not in stored_message_ids
+        ]
+        if not buffered_messages:
+            return history
+        return (list(history) + buffered_messages)[-db.MESSAGE_HISTORY_LIMIT :]
+
+    async def get_unsummarized_messages_from_channel(self, *args, **kwargs):
+        await self.flush_messages()
+        return await self.read(
+            db.get_unsummarized_messages_from_channel, *args, **kwargs
+        )
+
+    async def save_user_message_to_history(
+        self,
+        user_discord_id: str,
+        channel_discord_id: str,
+        message_discord_id: str,
+        message_content: str,
+        discord_username: str,
+    ):
+        await self.register_or_update_user_in_database(
+            user_discord_id, discord_username
+        )
+        author_name = await self.lookup_nickname(user_discord_id, channel_discord_id)
+        await self.save_message(
+            message_content, author_name, channel_discord_id, message_discord_id
+        )
+        await self.commit()
+
+    async def reset_memory_for_current_channel(self, channel_id: int):
+        # buffered messages have to be in the table to be archived with the rest
+        await self.flush_messages()
+        archived = await self.write(db.reset_memory_for_current_channel, channel_id)
+        conversation.forget_window(channel_id)
+        return archived
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.flush_messages()
+        logging.info(f"Metadata cache: {db.metadata_cache.stats()}")
+        for reader in self.readers:
+            await reader.close()
+        await self.writer.close()
@@ -1,9 +1,15 @@
 from __future__ import annotations
-from typing import Optional
+from typing import Optional, List
 from pathlib import Path
+import logging
 import sqlite3
 import os, yaml, json
-from . import api
+from . import caching
+
+# one database per process, so its rooms, users and characters can be cached here
+metadata_cache = caching.MetadataCache()
+# messages read back for a channel's history
+MESSAGE_HISTORY_LIMIT = 200
 
 
 def connect_to_db():  # standardise db connection name
@@ -14,13 +20,23 @@ def connect_to_db():  # standardise db connection name
 
 
 def setup_database(cursor: any, conn: any):
+    migrate_database(cursor, conn)
+
+
+######
+# each migration moves the schema up one version, the version is kept in PRAGMA user_version
+# only ever add new migrations to the end, databases already in use have run the earlier ones
+
+
+def create_tables(cursor: any):
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS room
                         (room_id INTEGER PRIMARY KEY, channel_id INTEGER, server_id INTEGER, scenario TEXT, free_to_speak INTEGER)"""
     )
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS characters
-                        (character_id INTEGER PRIMARY KEY, filename TEXT UNIQUE, name TEXT, persona TEXT, example_conversation TEXT, greeting TEXT)"""
+                        (character_id INTEGER PRIMARY KEY, filename TEXT UNIQUE, name TEXT, persona TEXT, example_conversation TEXT, greeting TEXT,
+                       persona_token_count INTEGER, example_conversation_token_count INTEGER, greeting_token_count INTEGER, file_hash TEXT, tokenizer_identity TEXT)"""
     )
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS users
@@ -33,8 +49,8 @@ def setup_database(cursor: any, conn: any):
     )
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS users_nickname
-                        (users_nickname_id INTEGER PRIMARY KEY, active_room INTEGER, user INTEGER, nickname TEXT,
-                       FOREIGN KEY(active_room) REFERENCES room(room_id), FOREIGN KEY(user) REFERENCES users(user_id))"""
+                        (users_nickname_id INTEGER PRIMARY KEY, active_room INTEGER, "user" INTEGER, nickname TEXT,
+                       FOREIGN KEY(active_room) REFERENCES room(room_id), FOREIGN KEY("user") REFERENCES users(user_id))"""
     )
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS messages
@@ -42,10 +58,179 @@ def setup_database(cursor: any, conn: any):
                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                        FOREIGN KEY(channel) REFERENCES room(room_id))"""
     )
-    conn.commit()
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS summaries
+                        (summary_id INTEGER PRIMARY KEY, room INTEGER UNIQUE, summary TEXT, last_message_id INTEGER,
+                       timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                       FOREIGN KEY(room) REFERENCES room(room_id), FOREIGN KEY(last_message_id) REFERENCES messages(message_id))"""
+    )
+
+
+def add_character_token_count_columns(cursor: any):
+    # databases made before the token counts were stored
+    add_missing_columns(
+        "characters",
+        {
+            "persona_token_count": "INTEGER",
+            "example_conversation_token_count": "INTEGER",
+            "greeting_token_count": "INTEGER",
+            "file_hash": "TEXT",
+            "tokenizer_identity": "TEXT",
+        },
+        cursor,
+    )
+
+
+def add_hot_path_indexes(cursor: any):
+    # almost every query starts by finding the room from the discord channel id
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS room_channel_id_index ON room(channel_id)"""
+    )
+    # history is read per room, without archived messages, newest first
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS messages_channel_archived_timestamp_index
+                        ON messages(channel, archived, timestamp)"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS active_characters_room_character_index
+                        ON active_characters(active_room, character)"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS users_nickname_room_user_index
+                        ON users_nickname(active_room, "user")"""
+    )
+
+
+def enable_incremental_vacuum(cursor: any):
+    # lets the space left by archived messages be handed back a little at a time,
+    # the setting only takes on an existing file after a full vacuum
+    cursor.execute("""PRAGMA auto_vacuum = INCREMENTAL""")
+    cursor.connection.commit()
+    cursor.execute("""VACUUM""")
+
+
+def add_unique_constraints(cursor: any):
+    # a channel could be registered twice, keep the room the bot has been reading and move the rest over to it
+    duplicate_rooms = """SELECT room_id FROM room WHERE room_id NOT IN (SELECT min(room_id) FROM room GROUP BY channel_id)"""
+    for table, column in [
+        ("messages", "channel"),
+        ("active_characters", "active_room"),
+        ("users_nickname", "active_room"),
+    ]:
+        cursor.execute(
+            f"""UPDATE {table}
+                  SET {column} = (SELECT min(kept.room_id) FROM room AS kept
+                                  INNER JOIN room AS duplicate ON duplicate.channel_id = kept.channel_id
+                                  WHERE duplicate.room_id = {table}.{column})
+                  WHERE {column} IN ({duplicate_rooms})"""
+        )
+    cursor.execute(f"""DELETE FROM summaries WHERE room IN ({duplicate_rooms})""")
+    cursor.execute(f"""DELETE FROM room WHERE room_id IN ({duplicate_rooms})""")
+    cursor.execute(
+        """DELETE FROM active_characters WHERE active_characters_id NOT IN
+              (SELECT min(active_characters_id) FROM active_characters GROUP BY active_room, character)"""
+    )
+    cursor.execute(
+        """DELETE FROM users_nickname WHERE users_nickname_id NOT IN
+              (SELECT min(users_nickname_id) FROM users_nickname GROUP BY active_room, "user")"""
+    )
+    # unique indexes let the writes below upsert in one statement, they replace the plain ones
+    cursor.execute("""DROP INDEX IF EXISTS room_channel_id_index""")
+    cursor.execute("""DROP INDEX IF EXISTS active_characters_room_character_index""")
+    cursor.execute("""DROP INDEX IF EXISTS users_nickname_room_user_index""")
+    cursor.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS room_channel_id_unique ON room(channel_id)"""
+    )
+    cursor.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS active_characters_room_character_unique
+                        ON active_characters(active_room, character)"""
+    )
+    cursor.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS users_nickname_room_user_unique
+                        ON users_nickname(active_room, "user")"""
+    )
+
+
+def add_message_tokenizer_identity_column(cursor: any):
+    # message counts are filled in later, and counted again when the tokenizer changes
+    add_missing_columns("messages", {"tokenizer_identity": "TEXT"}, cursor)
+
+
+def add_uncounted_messages_index(cursor: any):
+    # the token counter looks for these every few seconds, the index stays as small as what's left to count
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS messages_uncounted_index
+                        ON messages(message_id) WHERE archived = 0 AND token_count IS NULL"""
+    )
+
+
+def add_message_tokenizer_identity_index(cursor: any):
+    # counts from before the tokenizer was recorded can't be told apart, they're counted again
+    cursor.execute(
+        """UPDATE messages SET token_count = NULL WHERE tokenizer_identity IS NULL"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS messages_counted_tokenizer_identity_index
+                        ON messages(tokenizer_identity) WHERE archived = 0 AND token_count IS NOT NULL"""
+    )
+
+
+def add_archiving_indexes(cursor: any):
+    # the archiver looks for reset and old messages whenever the bot is idle, most times there are none
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS messages_reset_index
+                        ON messages(message_id) WHERE archived = 1"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS messages_timestamp_index ON messages(timestamp)"""
+    )
+
+
+MIGRATIONS = [
+    create_tables,
+    add_character_token_count_columns,
+    add_hot_path_indexes,
+    enable_incremental_vacuum,
+    add_unique_constraints,
+    add_message_tokenizer_identity_column,
+    add_uncounted_messages_index,
+    add_message_tokenizer_identity_index,
+    add_archiving_indexes,
+]
+
+
+def get_schema_version(cursor: any):
+    cursor.execute("""PRAGMA user_version""")
+    return cursor.fetchone()[0]
+
+
+def migrate_database(cursor: any, conn: any):
+    schema_version = get_schema_version(cursor)
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= schema_version:
+            continue
+        try:
+            migration(cursor)
+            cursor.execute(f"""PRAGMA user_version = {version}""")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise Exception(f"Error migrating database to version {version}: {e}")
+        logging.info(f"Migrated database to version {version}, {migration.__name__}")
+    return get_schema_version(cursor)
+
+
+def add_missing_columns(table: str, columns: dict, cursor: any):
+    cursor.execute(f"""PRAGMA table_info({table})""")
+    existing_columns = [column["name"] for column in cursor.fetchall()]
+    for column, column_type in columns.items():
+        if column not in existing_columns:
+            cursor.execute(f"""ALTER TABLE {table} ADD COLUMN {column} {column_type}""")
 
 
 def drop_everything(cursor: any):
+    metadata_cache.clear()
+    cursor.execute("""DROP TABLE summaries""")
     cursor.execute("""DROP TABLE messages""")
     cursor.execute("""DROP TABLE users_nickname""")
     cursor.execute("""DROP TABLE active_characters""")
@@ -56,6 +241,29 @@ def drop_everything(cursor: any):
 
 def rollback(conn: any):
     conn.rollback()
+    metadata_cache.rolled_back()
+
+
+def get_room_id(channel_id: int, cursor: any, must_exist: bool = True):
+    def load_room_id():
+        cursor.execute("""SELECT room_id FROM room WHERE channel_id=?""", (channel_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    room_id = metadata_cache.get_or_load("room_ids", channel_id, load_room_id)
+    if room_id is None and must_exist:
+        raise Exception(f"Channel {channel_id} is not registered.")
+    return room_id
+
+
+def forget_room(channel_id: int):
+    for table in ["room_ids", "free_to_speak", "scenarios"]:
+        metadata_cache.invalidate(table, channel_id)
+
+
+def forget_active_characters(channel_id: Optional[int] = None):
+    for table in ["active_characters", "active_character_counts"]:
+        metadata_cache.invalidate(table, channel_id)
 
 
 def check_existence_of_unique_record(
@@ -97,37 +305,42 @@ def register_or_update_character_in_database(
     cursor: any,
     character_example_conversation: Optional[str] = None,
     character_greeting: Optional[str] = None,
+    token_counts: Optional[dict] = None,
+    file_hash: Optional[str] = None,
+    tokenizer_identity: Optional[str] = None,
 ):
-    character_id_if_exists = check_existence_of_unique_record(
-        "characters", "character_id", "filename", character_filename, cursor
+    token_counts = token_counts or {}
+    cursor.execute(
+        """INSERT INTO characters
+                           (name, filename, persona, example_conversation, greeting,
+                           persona_token_count, example_conversation_token_count, greeting_token_count, file_hash, tokenizer_identity)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                           ON CONFLICT(filename) DO UPDATE SET
+                           name = excluded.name,
+                           persona = excluded.persona,
+                           example_conversation = excluded.example_conversation,
+                           greeting = excluded.greeting,
+                           persona_token_count = excluded.persona_token_count,
+                           example_conversation_token_count = excluded.example_conversation_token_count,
+                           greeting_token_count = excluded.greeting_token_count,
+                           file_hash = excluded.file_hash,
+                           tokenizer_identity = excluded.tokenizer_identity""",
+        (
+            character_name,
+            character_filename,
+            character_context,
+            character_example_conversation,
+            character_greeting,
+            token_counts.get("persona"),
+            token_counts.get("example_conversation"),
+            token_counts.get("greeting"),
+            file_hash,
+            tokenizer_identity,
+        ),
     )
-    if character_id_if_exists:
-        cursor.execute(
-            """INSERT OR REPLACE INTO characters
-                               (character_id, name, filename, persona, example_conversation, greeting)
-                               VALUES (?, ?, ?, ?, ?, ?)""",
-            (
-                character_id_if_exists,
-                character_name,
-                character_filename,
-                character_context,
-                character_example_conversation,
-                character_greeting,
-            ),
-        )
-    else:
-        cursor.execute(
-            """INSERT OR REPLACE INTO characters
-                               (name, filename, persona, example_conversation, greeting)
-                               VALUES (?, ?, ?, ?, ?)""",
-            (
-                character_name,
-                character_filename,
-                character_context,
-                character_example_conversation,
-                character_greeting,
-            ),
-        )
+    metadata_cache.invalidate("characters", character_filename)
+    # the persona and the rest are kept with each room's active characters too
+    forget_active_characters()
     return cursor.rowcount > 0  # true if successful
 
 
@@ -138,47 +351,43 @@ def retrieve_character_information_by_name(character_name: str, cursor: any):
 
 
 def retrieve_character_information_by_filename(filename: str, cursor: any):
-    cursor.execute("""SELECT * FROM characters WHERE filename=?""", (filename,))
-    rows = cursor.fetchall()
-    return rows
+    def load_character():
+        cursor.execute("""SELECT * FROM characters WHERE filename=?""", (filename,))
+        return cursor.fetchall()
+
+    return metadata_cache.get_or_load("characters", filename, load_character)
 
 
 def check_and_register_channel_in_database(
     channel_id: int, server_id: int, cursor: any, free_to_speak: bool = False
 ):
-    room_id_if_exists = check_existence_of_unique_record(
-        "room", "room_id", "channel_id", channel_id, cursor
-    )
+    room_id_if_exists = get_room_id(channel_id, cursor, must_exist=False)
     if not room_id_if_exists:
         cursor.execute(
-            """INSERT OR REPLACE INTO room
+            """INSERT INTO room
                               (channel_id, server_id, free_to_speak)
-                              VALUES (?, ?, ?)""",
+                              VALUES (?, ?, ?)
+                              ON CONFLICT(channel_id) DO NOTHING""",
             (channel_id, server_id, int(free_to_speak)),
         )
-    return cursor.rowcount > 0  # true if successful)
+        forget_room(channel_id)
+        return cursor.rowcount > 0
+    return False
 
 
 def register_or_update_channel_in_database(
     channel_id: int, server_id: int, free_to_speak: bool, cursor: any
 ):
-    room_id_if_exists = check_existence_of_unique_record(
-        "room", "room_id", "channel_id", channel_id, cursor
-    )
-    if room_id_if_exists:
-        cursor.execute(
-            """INSERT OR REPLACE INTO room
-                              (room_id, channel_id, server_id, free_to_speak)
-                              VALUES (?, ?, ?, ?)""",
-            (room_id_if_exists, channel_id, server_id, int(free_to_speak)),
-        )
-    else:
-        cursor.execute(
-            """INSERT OR REPLACE INTO room
-                              (channel_id, server_id, free_to_speak)
-                              VALUES (?, ?, ?)""",
-            (channel_id, server_id, int(free_to_speak)),
-        )
+    cursor.execute(
+        """INSERT INTO room
+                          (channel_id, server_id, free_to_speak)
+                          VALUES (?, ?, ?)
+                          ON CONFLICT(channel_id) DO UPDATE SET
+                          server_id = excluded.server_id,
+                          free_to_speak = excluded.free_to_speak""",
+        (channel_id, server_id, int(free_to_speak)),
+    )
+    forget_room(channel_id)
     return cursor.rowcount > 0  # true if successful
 
 
@@ -186,94 +395,83 @@ def toggle_channel_speakiness_and_return_speakiness(
     channel_id: int, server_id: int, cursor: any
 ):
     cursor.execute(
-        """SELECT free_to_speak, room_id FROM room WHERE channel_id = ?""",
-        (channel_id,),
+        """INSERT INTO room
+                    (channel_id, server_id, free_to_speak)
+                    VALUES (?, ?, 1)
+                    ON CONFLICT(channel_id) DO UPDATE SET
+                    free_to_speak = CASE WHEN room.free_to_speak = 1 THEN 0 ELSE 1 END
+                    RETURNING free_to_speak""",
+        (channel_id, server_id),
     )
+    speakiness = cursor.fetchone()[0]
+    forget_room(channel_id)
+    return speakiness == 1
 
-    result = cursor.fetchone()
-    speakiness = result["free_to_speak"] if result else None
-    if speakiness:
-        cursor.execute(
-            """INSERT OR REPLACE INTO room
-                        (room_id, channel_id, server_id, free_to_speak)
-                        VALUES (?, ?, ?, ?)""",
-            (result["room_id"], channel_id, server_id, int(speakiness == 0)),
-        )
-    else:
-        cursor.execute(
-            """INSERT OR REPLACE INTO room
-                        (channel_id, server_id, free_to_speak)
-                        VALUES (?, ?, ?)""",
-            (channel_id, server_id, 1),
-        )
-    return speakiness != 1
+
+def nickname_table(discord_id: int):
+    # a user's nicknames are cached on their own, so a change to one user leaves the rest cached
+    return f"nicknames_{discord_id}"
 
 
 def register_or_update_user_in_database(discord_id: int, username: int, cursor: any):
-    user_id_if_exists = check_existence_of_unique_record(
-        "users", "user_id", "discord_id", discord_id, cursor
-    )
-    if user_id_if_exists:
-        cursor.execute(
-            """INSERT OR REPLACE INTO users
-                              (user_id, discord_id, username)
-                               VALUES (?, ?, ?)""",
-            (user_id_if_exists, discord_id, username),
-        )
-    else:
-        cursor.execute(
-            """INSERT OR REPLACE INTO users
-                              (discord_id, username)
-                              VALUES (?, ?)""",
-            (discord_id, username),
-        )
-    return cursor.rowcount > 0  # true if successful
+    # runs for every message, but usernames hardly ever change
+    if metadata_cache.get("usernames", discord_id) == username:
+        return False
+    cursor.execute(
+        """INSERT INTO users
+                          (discord_id, username)
+                          VALUES (?, ?)
+                          ON CONFLICT(discord_id) DO UPDATE SET
+                          username = excluded.username
+                          WHERE users.username IS NULL OR users.username <> excluded.username""",
+        (discord_id, username),
+    )
+    changed = cursor.rowcount > 0
+    metadata_cache.put("usernames", discord_id, username)
+    if changed:
+        # the username is the nickname wherever one isn't set
+        metadata_cache.invalidate(nickname_table(discord_id))
+    return changed  # true if the user was added or renamed
 
 
 def add_or_update_user_nickname(
     discord_id: int, channel_id: int, nickname: str, cursor: any
 ):
-    cursor.execute("""SELECT user_id FROM users WHERE discord_id=?""", (discord_id,))
-    user_id = cursor.fetchone()[0]
-    cursor.execute("""SELECT room_id FROM room WHERE channel_id=?""", (channel_id,))
-    room_id = cursor.fetchone()[0]
-    table_id_if_exists = check_existence_of_unique_record_with_two_fields(
-        "users_nickname", "active_room", room_id, "user", user_id, cursor
-    )
-    if table_id_if_exists:
-        cursor.execute(
-            """INSERT OR REPLACE INTO users_nickname
-                              (users_nickname_id, active_room, user, nickname)
-                              VALUES (?, ?, ?, ?)""",
-            (table_id_if_exists, room_id, user_id, nickname),
-        )
-    else:
-        cursor.execute(
-            """INSERT OR REPLACE INTO users_nickname
-                              (active_room, user, nickname)
-                              VALUES (?, ?, ?)""",
-            (room_id, user_id, nickname),
-        )
+    room_id = get_room_id(channel_id, cursor)
+    cursor.execute(
+        """INSERT INTO users_nickname
+                          (active_room, "user", nickname)
+                          SELECT ?, user_id, ? FROM users WHERE discord_id = ?
+                          ON CONFLICT(active_room, "user") DO UPDATE SET
+                          nickname = excluded.nickname""",
+        (room_id, nickname, discord_id),
+    )
+    metadata_cache.put(nickname_table(discord_id), channel_id, nickname)
     return cursor.rowcount > 0  # true if successful
 
 
 def lookup_nickname(discord_id: int, channel_id: int, cursor: any):
-    cursor.execute(
-        """SELECT nickname
-                      FROM users_nickname
-                      INNER JOIN users ON users_nickname.user = users.user_id
-                      INNER JOIN room ON room.room_id = users_nickname.active_room
-                      WHERE users.discord_id = ? AND room.channel_id = ?""",
-        (discord_id, channel_id),
-    )
-    nickname = cursor.fetchone()
-    if nickname:
-        return nickname[0]
-    else:
+    def load_nickname():
         cursor.execute(
-            """SELECT username FROM users WHERE discord_id = ?""", (discord_id,)
+            """SELECT nickname
+                          FROM users_nickname
+                          INNER JOIN users ON users_nickname.user = users.user_id
+                          INNER JOIN room ON room.room_id = users_nickname.active_room
+                          WHERE users.discord_id = ? AND room.channel_id = ?""",
+            (discord_id, channel_id),
         )
-        return cursor.fetchone()[0]
+        nickname = cursor.fetchone()
+        if nickname:
+            return nickname[0]
+        else:
+            cursor.execute(
+                """SELECT username FROM users WHERE discord_id = ?""", (discord_id,)
+            )
+            return cursor.fetchone()[0]
+
+    return metadata_cache.get_or_load(
+        nickname_table(discord_id), channel_id, load_nickname
+    )
 
 
 def set_active_character_per_room(
@@ -284,81 +482,51 @@ def set_active_character_per_room(
     scenario: Optional[str] = None,
     negative_prompt: Optional[str] = None,
 ):
+    room_id = get_room_id(channel_id, cursor)
     cursor.execute(
-        """SELECT character_id FROM characters WHERE filename=?""",
-        (character_filename,),
-    )
-    character = cursor.fetchone()
-    if not character:
+        """INSERT INTO active_characters
+                          (active_room, character, active, scenario, negative_prompt)
+                          SELECT ?, character_id, ?, ?, ? FROM characters WHERE filename = ?
+                          ON CONFLICT(active_room, character) DO UPDATE SET
+                          active = excluded.active,
+                          scenario = excluded.scenario,
+                          negative_prompt = excluded.negative_prompt""",
+        (room_id, int(is_active), scenario, negative_prompt, character_filename),
+    )
+    if cursor.rowcount == 0:
         raise Exception("Character not found.")
-    char_id = character[0]
-    cursor.execute("""SELECT room_id FROM room WHERE channel_id=?""", (channel_id,))
-    room_id = cursor.fetchone()[0]
-    table_id_if_exists = check_existence_of_unique_record_with_two_fields(
-        "active_characters", "active_room", room_id, "character", char_id, cursor
-    )
-    if table_id_if_exists:
-        cursor.execute(
-            """INSERT OR REPLACE INTO active_characters
-                              (active_characters_id, active_room, character, active, scenario, negative_prompt)
-                              VALUES (?, ?, ?, ?, ?, ?)""",
-            (
-                table_id_if_exists,
-                room_id,
-                char_id,
-                int(is_active),
-                scenario,
-                negative_prompt,
-            ),
-        )
-    else:
-        cursor.execute(
-            """INSERT OR REPLACE INTO active_characters
-                              (active_room, character, active, scenario, negative_prompt)
-                              VALUES (?, ?, ?, ?, ?)""",
-            (room_id, char_id, int(is_active), scenario, negative_prompt),
-        )
+    forget_active_characters(channel_id)
     return cursor.rowcount > 0  # true if successful
 
 
 def toggle_character_activity_and_return_activity(
     character_filename: str, channel_id: int, cursor: any
 ):
+    room_id = get_room_id(channel_id, cursor)
     cursor.execute(
-        """SELECT character_id FROM characters WHERE filename=?""",
-        (character_filename,),
-    )
-    char_id = cursor.fetchone()[0]
-    cursor.execute("""SELECT room_id FROM room WHERE channel_id=?""", (channel_id,))
-    room_id = cursor.fetchone()[0]
-    cursor.execute(
-        """SELECT active_characters_id, active FROM active_characters WHERE character = ? AND active_room = ?""",
-        (char_id, room_id),
+        """INSERT INTO active_characters
+                          (active_room, character, active)
+                          SELECT ?, character_id, 1 FROM characters WHERE filename = ?
+                          ON CONFLICT(active_room, character) DO UPDATE SET
+                          active = CASE WHEN active_characters.active = 1 THEN 0 ELSE 1 END
+                          RETURNING active""",
+        (room_id, character_filename),
     )
     result = cursor.fetchone()
-    activity = result["active"] if result else None
-    if activity == None:
-        cursor.execute(
-            """INSERT OR REPLACE INTO active_characters
-                                (active_room, character, active)
-                                VALUES (?, ?, ?)""",
-            (room_id, char_id, 1),
-        )
-    else:
-        cursor.execute(
-            """INSERT OR REPLACE INTO active_characters
-                (active_characters_id, active_room, character, active)
-                VALUES (?, ?, ?, ?)""",
-            (result["active_characters_id"], room_id, char_id, int(activity == 0)),
-        )
-    return activity != 1
+    if not result:
+        raise Exception("Character not found.")
+    forget_active_characters(channel_id)
+    return result[0] == 1
 
 
 def can_bot_speak_freely_in_current_room(channel_id: int, cursor: any):
-    cursor.execute(
-        """SELECT free_to_speak FROM room WHERE channel_id = ?""", (channel_id,)
-    )
-    return cursor.fetchone()[0] == 1
+    def load_free_to_speak():
+        cursor.execute(
+            """SELECT free_to_speak FROM room WHERE channel_id = ?""", (channel_id,)
+        )
+        return cursor.fetchone()[0] == 1
+
+    return metadata_cache.get_or_load("free_to_speak", channel_id, load_free_to_speak)
 
 
 # assume that you run the register room command somewhere before this
@@ -366,13 +534,19 @@ def add_scenario_to_current_room(channel_id: int, scenario: Optional[str], curso
     cursor.execute(
         """UPDATE room SET scenario = ? WHERE channel_id = ?""", (scenario, channel_id)
     )
+    forget_room(channel_id)
     return cursor.rowcount > 0
 
 
 def get_scenario_from_current_room(channel_id: int, cursor: any):
-    cursor.execute("""SELECT scenario FROM room WHERE channel_id = ?""", (channel_id,))
-    scenario = cursor.fetchone()
-    return scenario[0] if scenario else None
+    def load_scenario():
+        cursor.execute(
+            """SELECT scenario FROM room WHERE channel_id = ?""", (channel_id,)
+        )
+        scenario = cursor.fetchone()
+        return scenario[0] if scenario else None
+
+    return metadata_cache.get_or_load("scenarios", channel_id, load_scenario)
 
 
 def get_nicknames_per_room(channel_id: int, cursor: any):
@@ -389,29 +563,40 @@ def get_nicknames_per_room(channel_id: int, cursor: any):
 
 
 def get_active_character_data_per_room(channel_id: int, cursor: any):
-    cursor.execute(
-        """SELECT characters.character_id as id, characters.name as name, filename, persona, example_conversation, greeting, active_characters.scenario as scenario, active_characters.negative_prompt as negative_prompt
-                      FROM characters
-                      INNER JOIN active_characters
-                      ON active_characters.character = characters.character_id
-                      INNER JOIN room ON room.room_id = active_characters.active_room
-                      WHERE room.channel_id = ? AND active_characters.active = 1""",
-        (channel_id,),
+    def load_active_characters():
+        cursor.execute(
+            """SELECT characters.character_id as id, characters.name as name, filename, persona, example_conversation, greeting, active_characters.scenario as scenario, active_characters.negative_prompt as negative_prompt,
+                          persona_token_count, example_conversation_token_count, tokenizer_identity
+                          FROM characters
+                          INNER JOIN active_characters
+                          ON active_characters.character = characters.character_id
+                          INNER JOIN room ON room.room_id = active_characters.active_room
+                          WHERE room.channel_id = ? AND active_characters.active = 1""",
+            (channel_id,),
+        )
+        return cursor.fetchall()
+
+    return metadata_cache.get_or_load(
+        "active_characters", channel_id, load_active_characters
     )
-    return cursor.fetchall()
 
 
 def get_active_character_count_per_room(channel_id: int, cursor: any):
-    cursor.execute(
-        """SELECT count(*)
-            FROM characters
-            INNER JOIN active_characters
-            ON active_characters.character = characters.character_id
-            INNER JOIN room ON room.room_id = active_characters.active_room
-            WHERE room.channel_id = ? AND active_characters.active = 1""",
-        (channel_id,),
+    def load_active_character_count():
+        cursor.execute(
+            """SELECT count(*)
+                FROM characters
+                INNER JOIN active_characters
+                ON active_characters.character = characters.character_id
+                INNER JOIN room ON room.room_id = active_characters.active_room
+                WHERE room.channel_id = ? AND active_characters.active = 1""",
+            (channel_id,),
+        )
+        return cursor.fetchone()[0]
+
+    return metadata_cache.get_or_load(
+        "active_character_counts", channel_id, load_active_character_count
     )
-    return cursor.fetchone()[0]
 
 
 def deactivate_all(channel_id: int, cursor: any):
@@ -430,6 +615,7 @@ def deactivate_all(channel_id: int, cursor: any):
             channel_id,
         ),
     )
+    forget_active_characters(channel_id)
     return cursor.rowcount > 0
 
 
@@ -446,6 +632,7 @@ def reset_all_active_character_scenarios(channel_id: int, cursor: any):
             channel_id,
         ),
     )
+    forget_active_characters(channel_id)
     return cursor.rowcount > 0
 
 
@@ -453,38 +640,105 @@ def save_message(
     message: str,
     author: str,
     channel_id: int,
-    message_id: int,
+    message_id: Optional[int],
     cursor: any,
-    should_count_tokens: Optional[bool] = False,
+    token_count: Optional[int] = None,
 ):
-    cursor.execute("""SELECT room_id FROM room WHERE channel_id=?""", (channel_id,))
-    room_id = cursor.fetchone()[0]
-
-    token_count = (
-        api.count_tokens(f"{author}: {message}") if should_count_tokens else None
-    )
+    """Stores a message, returns its row id, or None if nothing was stored"""
+    room_id = get_room_id(channel_id, cursor)
 
     # TODO: put check for unique record here for message updating, don't feel like doing it now
 
     cursor.execute(
-        """INSERT OR REPLACE INTO messages
+        """INSERT INTO messages
                        (discord_id, channel, author, message_content, token_count, archived)
                        VALUES
-                       (?, ?, ?, ?, ?, ?)""",
+                       (?, ?, ?, ?, ?, ?)
+                       RETURNING message_id""",
         (message_id, room_id, author, message, token_count, 0),
     )
-    return cursor.rowcount > 0  # true if successful
+    row = cursor.fetchone()
+    return row[0] if row else None
 
 
-def get_message_history_from_channel(channel_id: str, cursor: any):
+def save_messages(messages: List[dict], cursor: any):
+    cursor.executemany(
+        """INSERT INTO messages
+                       (message_id, discord_id, channel, author, message_content, token_count, archived, timestamp)
+                       VALUES
+                       (?, ?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (
+                message["message_id"],
+                message["discord_id"],
+                get_room_id(message["channel_id"], cursor),
+                message["author"],
+                message["message_content"],
+                message["token_count"],
+                0,
+                message["timestamp"],
+            )
+            for message in messages
+        ],
+    )
+    return cursor.rowcount
+
+
+def get_messages_to_count(tokenizer_identity: str, limit: int, cursor: any):
     cursor.execute(
-        """SELECT message_content, author, token_count
+        """SELECT message_id, room.channel_id AS channel_id, author, message_content
                       FROM messages
                       INNER JOIN room ON room.room_id = messages.channel
-                      WHERE room.channel_id = ? and messages.archived = 0
-                      ORDER BY messages.timestamp
-                      ASC LIMIT 200""",
-        (channel_id,),
+                      WHERE messages.archived = 0 and messages.token_count IS NULL
+                      ORDER BY messages.message_id
+                      DESC LIMIT ?""",
+        (limit,),
+    )
+    messages = cursor.fetchall()
+    if len(messages) < limit:
+        # two ranges rather than <>, so each one is a search of the index
+        cursor.execute(
+            """SELECT messages.message_id, room.channel_id AS channel_id, author, message_content
+                          FROM (SELECT message_id FROM messages
+                                WHERE archived = 0 and token_count IS NOT NULL and tokenizer_identity < ?
+                                UNION ALL
+                                SELECT message_id FROM messages
+                                WHERE archived = 0 and token_count IS NOT NULL and tokenizer_identity > ?
+                                LIMIT ?) AS stale
+                          INNER JOIN messages ON messages.message_id = stale.message_id
+                          INNER JOIN room ON room.room_id = messages.channel""",
+            (tokenizer_identity, tokenizer_identity, limit - len(messages)),
+        )
+        messages += cursor.fetchall()
+    return messages
+
+
+def save_message_token_counts(token_counts: dict, tokenizer_identity: str, cursor: any):
+    cursor.executemany(
+        """UPDATE messages SET token_count = ?, tokenizer_identity = ? WHERE message_id = ?""",
+        [
+            (token_count, tokenizer_identity, message_id)
+            for message_id, token_count in token_counts.items()
+        ],
+    )
+    return cursor.rowcount
+
+
+def get_next_message_id(cursor: any):
+    cursor.execute("""SELECT coalesce(max(message_id), 0) + 1 FROM messages""")
+    return cursor.fetchone()[0]
+
+
+def get_message_history_from_channel(channel_id: str, cursor: any):
+    cursor.execute(
+        """SELECT message_id, message_content, author, token_count, tokenizer_identity FROM
+                      (SELECT message_id, message_content, author, token_count, tokenizer_identity, timestamp
+                      FROM messages
+                      WHERE messages.channel = (SELECT room_id FROM room WHERE room.channel_id = ?) and messages.archived = 0
+                      ORDER BY messages.timestamp DESC, messages.message_id DESC
+                      LIMIT ?)
+                      ORDER BY timestamp ASC, message_id ASC""",
+        (channel_id, MESSAGE_HISTORY_LIMIT),
     )
     return cursor.fetchall()
 
@@ -499,7 +753,13 @@ def reset_memory_for_current_channel(channel_id: str, cursor: any):
               """,
         (channel_id,),
     )
-    return cursor.rowcount > 0
+    archived = cursor.rowcount > 0
+    cursor.execute(
+        """DELETE FROM summaries
+              WHERE room = (SELECT room_id FROM room WHERE room.channel_id = ?)""",
+        (channel_id,),
+    )
+    return archived
 
 
 def get_message_history_with_channel_before_specific_message_id(
@@ -527,6 +787,132 @@ def get_message_history_with_channel_before_specific_message_id(
     return cursor.fetchall()
 
 
+def get_summary_for_channel(channel_id: int, cursor: any):
+    cursor.execute(
+        """SELECT summary, last_message_id
+                      FROM summaries
+                      INNER JOIN room ON room.room_id = summaries.room
+                      WHERE room.channel_id = ?""",
+        (channel_id,),
+    )
+    return cursor.fetchone()
+
+
+def save_summary_for_channel(
+    channel_id: int, summary: str, last_message_id: int, cursor: any
+):
+    room_id = get_room_id(channel_id, cursor)
+    cursor.execute(
+        """INSERT INTO summaries (room, summary, last_message_id)
+                      VALUES (?, ?, ?)
+                      ON CONFLICT(room) DO UPDATE SET
+                      summary = excluded.summary,
+                      last_message_id = excluded.last_message_id,
+                      timestamp = CURRENT_TIMESTAMP""",
+        (room_id, summary, last_message_id),
+    )
+    return cursor.rowcount > 0
+
+
+def get_unsummarized_messages_from_channel(
+    channel_id: int,
+    after_message_id: Optional[int],
+    before_message_id: int,
+    cursor: any,
+    limit: int = 30,
+):
+    cursor.execute(
+        """SELECT message_id, message_content, author, token_count
+                      FROM messages
+                      INNER JOIN room ON room.room_id = messages.channel
+                      WHERE room.channel_id = ? and messages.archived = 0
+                      and messages.message_id > ? and messages.message_id < ?
+                      ORDER BY messages.message_id
+                      ASC LIMIT ?""",
+        (channel_id, after_message_id or 0, before_message_id, limit),
+    )
+    return cursor.fetchall()
+
+
+######
+# the archive is a second database attached to the writer, messages that are reset or old enough are moved there
+
+
+def attach_archive(archive_path: str, cursor: any):
+    # setup runs again when discord reconnects, by then the writer has it attached already
+    attached = [row[1] for row in cursor.execute("""PRAGMA database_list""")]
+    if "archive" in attached:
+        return
+    cursor.execute("""ATTACH DATABASE ? AS archive""", (archive_path,))
+    # only takes on a new file, before the table below is made
+    cursor.execute("""PRAGMA archive.auto_vacuum = INCREMENTAL""")
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS archive.messages
+                        (message_id INTEGER PRIMARY KEY, discord_id INTEGER, channel int, author TEXT, message_content TEXT, token_count INTEGER,
+                       timestamp DATETIME, archived_at DATETIME DEFAULT CURRENT_TIMESTAMP)"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS archive.archived_messages_timestamp_index
+                        ON messages(timestamp)"""
+    )
+
+
+def archive_messages(max_age_days: int, batch_size: int, cursor: any):
+    # the newest message always stays, new messages are numbered after it so ids are never given out twice,
+    # reset and old messages are looked up apart so each lookup is a search of an index
+    cursor.execute(
+        """SELECT message_id FROM messages
+                      WHERE archived = 1 AND message_id < (SELECT max(message_id) FROM messages)
+                      ORDER BY message_id
+                      LIMIT ?""",
+        (batch_size,),
+    )
+    message_ids = [row[0] for row in cursor.fetchall()]
+    if max_age_days > 0 and len(message_ids) < batch_size:
+        cursor.execute(
+            """SELECT message_id FROM messages
+                          WHERE timestamp < datetime('now', '-' || ? || ' days')
+                          AND archived = 0 AND message_id < (SELECT max(message_id) FROM messages)
+                          ORDER BY timestamp
+                          LIMIT ?""",
+            (max_age_days, batch_size - len(message_ids)),
+        )
+        message_ids += [row[0] for row in cursor.fetchall()]
+    if not message_ids:
+        return 0
+    placeholders = ", ".join("?" * len(message_ids))
+    # replacing makes a batch that was copied but never deleted safe to move again
+    cursor.execute(
+        f"""INSERT OR REPLACE INTO archive.messages
+                       (message_id, discord_id, channel, author, message_content, token_count, timestamp)
+                       SELECT message_id, discord_id, channel, author, message_content, token_count, timestamp
+                       FROM messages WHERE message_id IN ({placeholders})""",
+        message_ids,
+    )
+    cursor.execute(
+        f"""DELETE FROM messages WHERE message_id IN ({placeholders})""", message_ids
+    )
+    return len(message_ids)
+
+
+def delete_expired_archived_messages(retention_days: int, cursor: any):
+    cursor.execute(
+        """DELETE FROM archive.messages WHERE timestamp < datetime('now', '-' || ? || ' days')""",
+        (retention_days,),
+    )
+    return cursor.rowcount
+
+
+def incremental_vacuum(pages: int, cursor: any, schema: str = "main"):
+    """Hands up to that many free pages back to the disk, 0 hands back all of them"""
+    cursor.execute(f"""PRAGMA {schema}.freelist_count""")
+    free_pages = cursor.fetchone()[0]
+    # execute stops after the first page, a script is stepped through to the end
+    cursor.executescript(f"""PRAGMA {schema}.incremental_vacuum({pages})""")
+    cursor.execute(f"""PRAGMA {schema}.freelist_count""")
+    return free_pages - cursor.fetchone()[0]
+
+
 #######
 def load_character_data_from_file(filepath: str):
     file_contents = open(filepath, "r", encoding="utf-8").read()
@@ -547,25 +933,3 @@ def load_character_data_from_file(filepath: str):
         "context": data.get("context") or data.get("persona"),
         "example_conversation": example_convo,
     }
-
-
-def save_user_message_to_history(
-    user_discord_id: str,
-    channel_discord_id: str,
-    message_discord_id: str,
-    message_content: str,
-    discord_username: str,
-    cursor: any,
-    conn: any,
-):
-    register_or_update_user_in_database(user_discord_id, discord_username, cursor)
-    author_name = lookup_nickname(user_discord_id, channel_discord_id, cursor)
-    save_message(
-        message_content,
-        author_name,
-        channel_discord_id,
-        message_discord_id,
-        cursor,
-        True,
-    )
-    conn.commit()
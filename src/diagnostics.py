@@ -0,0 +1,315 @@
+from __future__ import annotations
+from typing import Optional, List
+import argparse
+import asyncio
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from . import db
+from .database import AsyncDatabase
+
+# python -m src.diagnostics, checks that the queries run on every message are served by an index
+# runs against a fresh in-memory database by default, or a copy of the schema in --database
+# with --stress, hammers a database file with concurrent readers and writers instead
+
+
+def connect(database: str = ":memory:"):
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    return conn, conn.cursor()
+
+
+def add_sample_rows(cursor: any, conn: any):
+    db.register_or_update_character_in_database(
+        "Sample", "sample", "A sample character", cursor
+    )
+    db.check_and_register_channel_in_database(1, 1, cursor)
+    db.register_or_update_user_in_database(1, "sample user", cursor)
+    db.add_or_update_user_nickname(1, 1, "sample nickname", cursor)
+    db.set_active_character_per_room("sample", 1, cursor)
+    conn.commit()
+
+
+def run_hot_paths(cursor: any):
+    db.check_and_register_channel_in_database(1, 1, cursor)
+    db.register_or_update_user_in_database(1, "sample user", cursor)
+    db.lookup_nickname(1, 1, cursor)
+    db.can_bot_speak_freely_in_current_room(1, cursor)
+    db.get_scenario_from_current_room(1, cursor)
+    db.get_active_character_data_per_room(1, cursor)
+    db.get_active_character_count_per_room(1, cursor)
+    db.set_active_character_per_room("sample", 1, cursor)
+    db.save_message("hello", "sample user", 1, 1, cursor)
+    # and the token counter every few seconds
+    db.get_messages_to_count("sample", 100, cursor)
+    db.save_message_token_counts({1: 1}, "sample", cursor)
+    db.get_message_history_from_channel(1, cursor)
+    db.get_summary_for_channel(1, cursor)
+    db.get_unsummarized_messages_from_channel(1, None, 2, cursor)
+    # and the archiver whenever the bot is idle
+    db.archive_messages(90, 500, cursor)
+    db.reset_memory_for_current_channel(1, cursor)
+
+
+def upsert_calls(attempt: str):
+    return [
+        (
+            db.register_or_update_character_in_database,
+            ("Other", "other", f"An {attempt} character"),
+        ),
+        (db.register_or_update_channel_in_database, (2, 1, attempt == "new")),
+        (db.check_and_register_channel_in_database, (3, 1)),
+        (db.toggle_channel_speakiness_and_return_speakiness, (4, 1)),
+        (db.register_or_update_user_in_database, (2, f"{attempt} user")),
+        (db.add_or_update_user_nickname, (2, 2, f"{attempt} nickname")),
+        (db.set_active_character_per_room, ("other", 2)),
+        (db.toggle_character_activity_and_return_activity, ("other", 3)),
+    ]
+
+
+def count_statements():
+    conn, cursor = connect()
+    db.setup_database(cursor, conn)
+    add_sample_rows(cursor, conn)
+    counts = {}
+    # the first round makes each row, the second finds it already there
+    for attempt in ["new", "existing"]:
+        for function, args in upsert_calls(attempt):
+            db.metadata_cache.clear()
+            statements = []
+            conn.set_trace_callback(statements.append)
+            function(*args, cursor)
+            conn.set_trace_callback(None)
+            counts.setdefault(function.__name__, []).append(
+                sum(
+                    bool(re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE)", statement, re.I))
+                    for statement in statements
+                )
+            )
+    conn.close()
+    return counts
+
+
+def is_full_scan(plan_detail: str, tables: List[str], partial_indexes: List[str]):
+    # "SCAN messages" reads every row, "SEARCH messages USING INDEX ..." doesn't,
+    # and neither does a scan of a partial index, it only holds the rows the query is after
+    match = re.match(r"SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?", plan_detail)
+    return (
+        bool(match)
+        and match.group(1) in tables
+        and match.group(2) not in partial_indexes
+    )
+
+
+def check_query_plans(database: Optional[str] = None):
+    conn, cursor = connect()
+    if database:
+        # only the schema is copied, so the real database is never written to
+        source_conn, source_cursor = connect(database)
+        source_cursor.execute(
+            """SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"""
+        )
+        for row in source_cursor.fetchall():
+            cursor.execute(row["sql"])
+        source_cursor.execute("""PRAGMA user_version""")
+        cursor.execute(f"""PRAGMA user_version = {source_cursor.fetchone()[0]}""")
+        source_conn.close()
+    else:
+        db.setup_database(cursor, conn)
+    add_sample_rows(cursor, conn)
+
+    cursor.execute("""SELECT name FROM sqlite_master WHERE type = 'table'""")
+    tables = [row["name"] for row in cursor.fetchall()]
+    cursor.execute(
+        """SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '% WHERE %'"""
+    )
+    partial_indexes = [row["name"] for row in cursor.fetchall()]
+
+    # with the metadata cache warm most of the hot queries wouldn't run at all
+    db.metadata_cache.clear()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    run_hot_paths(cursor)
+    conn.set_trace_callback(None)
+    conn.rollback()
+
+    results = []
+    for statement in dict.fromkeys(statements):
+        if not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE)", statement, re.IGNORECASE):
+            continue
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}")
+        plan = [row["detail"] for row in cursor.fetchall()]
+        results.append(
+            (
+                statement,
+                plan,
+                any(is_full_scan(detail, tables, partial_indexes) for detail in plan),
+            )
+        )
+    conn.close()
+    return results
+
+
+async def stress_test(
+    filepath: str,
+    reader_tasks: int = 16,
+    writer_tasks: int = 4,
+    seconds: float = 10,
+    reader_count: int = 4,
+    channel_count: int = 8,
+    flush_interval: float = 1.0,
+    engine: str = "sqlite",
+    dsn: Optional[str] = None,
+):
+    """Reads histories and saves messages from many tasks at once, returns what happened"""
+    database = AsyncDatabase(
+        filepath,
+        reader_count=reader_count,
+        message_flush_interval=flush_interval,
+        engine=engine,
+        dsn=dsn,
+    )
+    await database.setup_database()
+    for channel_id in range(channel_count):
+        await database.check_and_register_channel_in_database(channel_id, 1)
+    await database.commit()
+
+    stats = {"reads": 0, "writes": 0, "errors": 0, "max_concurrent_reads": 0}
+    read_latencies = []
+    concurrent_reads = 0
+    deadline = time.monotonic() + seconds
+
+    async def read_histories():
+        nonlocal concurrent_reads
+        while time.monotonic() < deadline:
+            concurrent_reads += 1
+            stats["max_concurrent_reads"] = max(
+                stats["max_concurrent_reads"], concurrent_reads
+            )
+            start_time = time.monotonic()
+            try:
+                history = await database.get_message_history_from_channel(
+                    random.randrange(channel_count)
+                )
+                message_ids = [message["message_id"] for message in history]
+                if message_ids != sorted(message_ids) or len(message_ids) > 200:
+                    raise Exception("History out of order")
+                stats["reads"] += 1
+                read_latencies.append(time.monotonic() - start_time)
+            except Exception as e:
+                stats["errors"] += 1
+                print(f"read failed: {e}")
+            finally:
+                concurrent_reads -= 1
+
+    async def save_messages(writer_number: int):
+        while time.monotonic() < deadline:
+            try:
+                await database.save_message(
+                    f"message from writer {writer_number} " * 10,
+                    f"writer {writer_number}",
+                    random.randrange(channel_count),
+                    None,
+                )
+                await database.commit()
+                stats["writes"] += 1
+            except Exception as e:
+                await database.rollback()
+                stats["errors"] += 1
+                print(f"write failed: {e}")
+
+    await asyncio.gather(
+        *[asyncio.create_task(read_histories()) for _ in range(reader_tasks)],
+        *[
+            asyncio.create_task(save_messages(writer_number))
+            for writer_number in range(writer_tasks)
+        ],
+    )
+    await database.close()
+    read_latencies.sort()
+    stats["p95_read_latency"] = (
+        read_latencies[int(len(read_latencies) * 0.95)] if read_latencies else None
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the bot's per-message queries use indexes"
+    )
+    parser.add_argument(
+        "--database", default=None, help="check the schema of an existing database"
+    )
+    parser.add_argument("--verbose", action="store_true", help="print every plan")
+    parser.add_argument(
+        "--stress",
+        action="store_true",
+        help="run concurrent readers and writers against a scratch database file",
+    )
+    parser.add_argument(
+        "--count",
+        action="store_true",
+        help="count the statements each register or update function runs",
+    )
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--reader-tasks", type=int, default=16)
+    parser.add_argument("--writer-tasks", type=int, default=4)
+    parser.add_argument(
+        "--readers", type=int, default=4, help="reader connections in the pool"
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=1.0,
+        help="seconds messages are buffered for, 0 writes each one straight away",
+    )
+    parser.add_argument(
+        "--engine",
+        default="sqlite",
+        choices=["sqlite", "memory", "postgres"],
+        help="database engine to stress",
+    )
+    parser.add_argument("--dsn", default=None, help="postgres database to stress")
+    args = parser.parse_args()
+
+    if args.stress:
+        with tempfile.TemporaryDirectory() as directory:
+            stats = asyncio.run(
+                stress_test(
+                    os.path.join(directory, "stress.db"),
+                    args.reader_tasks,
+                    args.writer_tasks,
+                    args.seconds,
+                    args.readers,
+                    flush_interval=args.flush_interval,
+                    engine=args.engine,
+                    dsn=args.dsn,
+                )
+            )
+        print(
+            f"{stats['reads'] / args.seconds:.0f} reads/s, {stats['writes'] / args.seconds:.0f} writes/s, "
+            f"p95 read latency {stats['p95_read_latency'] * 1000:.1f} ms, "
+            f"{stats['max_concurrent_reads']} reads in flight at most, {stats['errors']} errors"
+        )
+        sys.exit(1 if stats["errors"] else 0)
+
+    if args.count:
+        counts = count_statements()
+        for name, (new, existing) in counts.items():
+            print(f"{name}: {new} for a new row, {existing} for an existing one")
+        print(f"{sum(sum(count) for count in counts.values())} statements in total")
+        sys.exit(0)
+
+    results = check_query_plans(args.database)
+    for statement, plan, scans in results:
+        if scans or args.verbose:
+            print(("FULL SCAN: " if scans else "ok: ") + " ".join(statement.split()))
+            for detail in plan:
+                print(f"    {detail}")
+    failures = sum(scans for _, _, scans in results)
+    print(f"{len(results) - failures}/{len(results)} queries use an index")
+    sys.exit(1 if failures else 0)
@@ -2,8 +2,9 @@ from __future__ import annotations
 from pathlib import Path
 import logging
 from typing import Optional
+import hashlib
 import os, yaml, json, glob
-from . import db
+from . import api
 
 
 def get_dict_from_filepath(filepath: Optional[str]):
@@ -38,6 +39,14 @@ def load_config(filepath: str):
     config = {
         "context_length": config.get("context_length", 2046),
         "add_hashes_to_conversation": config.get("add_hashes_to_conversation", False),
+        "prompt_layout": config.get("prompt_layout", "default"),
+        "stable_layout_truncate_to": config.get("stable_layout_truncate_to", 0.6),
+        "prompt_segments": config.get("prompt_segments", None),
+        "summarize_evicted_history": config.get("summarize_evicted_history", False),
+        "summary_idle_seconds": config.get("summary_idle_seconds", 60),
+        "summary_max_tokens": config.get("summary_max_tokens", 200),
+        "summary_batch_size": config.get("summary_batch_size", 30),
+        "shutdown_drain_seconds": config.get("shutdown_drain_seconds", 30),
         "prompt_config": prompt_config,
         "character_directories": config.get("character_directories"),
         "max_rounds_in_continuation": max_turns,
@@ -47,15 +56,50 @@ def load_config(filepath: str):
         "max_characters_in_group_chat": config.get(
             "max_characters_in_group_chat", None
         ),
+        "api_backends": config.get("api_backends", None),
+        "api_url": config.get("api_url", "http://127.0.0.1:5000"),
+        "api_connect_timeout": config.get("api_connect_timeout", 10),
+        "api_read_timeout": config.get("api_read_timeout", 300),
+        "api_max_connections": config.get("api_max_connections", 8),
+        "streaming_api_url": config.get("streaming_api_url", "ws://127.0.0.1:5005"),
+        "api_health_check_interval": config.get("api_health_check_interval", 30),
+        "api_max_consecutive_failures": config.get("api_max_consecutive_failures", 3),
+        "api_hedge_requests": config.get("api_hedge_requests", False),
+        "api_hedge_percentile": config.get("api_hedge_percentile", 95),
+        "api_hedge_min_samples": config.get("api_hedge_min_samples", 20),
+        "stream_responses": config.get("stream_responses", False),
+        "stream_edit_interval": config.get("stream_edit_interval", 1.5),
+        "api_batch_token_count": config.get("api_batch_token_count", False),
+        "tokenizer_path": config.get("tokenizer_path", None),
+        "tokenizer_add_special_tokens": config.get(
+            "tokenizer_add_special_tokens", True
+        ),
+        "token_count_cache_size": config.get("token_count_cache_size", 50000),
+        "token_count_batch_size": config.get("token_count_batch_size", 100),
+        "token_count_interval": config.get("token_count_interval", 5),
+        "token_count_cache_path": config.get("token_count_cache_path", None),
+        "database_engine": config.get("database_engine", "sqlite"),
+        "database_path": config.get("database_path", "bot.db"),
+        "database_dsn": config.get("database_dsn", None),
+        "database_pragmas": config.get("database_pragmas", None),
+        "database_readers": config.get("database_readers", 4),
+        "message_buffer_size": config.get("message_buffer_size", 50),
+        "message_flush_interval": config.get("message_flush_interval", 1.0),
+        "archive_path": config.get("archive_path", None),
+        "archive_interval_seconds": config.get("archive_interval_seconds", 300),
+        "archive_batch_size": config.get("archive_batch_size", 500),
+        "archive_after_days": config.get("archive_after_days", 90),
+        "archive_retention_days": config.get("archive_retention_days", 0),
+        "vacuum_pages": config.get("vacuum_pages", 1000),
     }
 
     return discord_token, config
 
 
-def load_all_characters_in_filepath(filepath: str, cursor: any, logging: any):
+async def load_all_characters_in_filepath(filepath: str, database: any, logging: any):
     character_filepaths = []
     for file in glob.glob(os.path.join(filepath, f"*.yaml")):
-        load_or_update_character_data_from_file(file, cursor, logging)
+        await load_or_update_character_data_from_file(file, database, logging)
         character_filepaths.append(Path(file).stem)
     return character_filepaths
 
@@ -74,6 +118,7 @@ def load_character_data_from_file(filepath: str):
         )
 
     return {
+        "file_hash": hashlib.sha256(file_contents.encode("utf-8")).hexdigest(),
         "filename": Path(filepath).stem,
         "name": charname,
         "greeting": data.get("greeting"),
@@ -82,18 +127,74 @@ def load_character_data_from_file(filepath: str):
     }
 
 
+async def count_character_tokens(chardata: dict):
+    fields = {
+        "persona": chardata["context"],
+        "example_conversation": chardata["example_conversation"],
+        "greeting": chardata["greeting"],
+    }
+    tokenizer_identity = await api.get_tokenizer_identity()
+    if tokenizer_identity is None:
+        raise Exception("the loaded model isn't known yet")
+    token_counts = await api.count_tokens_many(
+        [""] + [text for text in fields.values() if text]
+    )
+    special_token_count, field_token_counts = token_counts[0], iter(token_counts[1:])
+    return {
+        name: next(field_token_counts) - special_token_count if text else 0
+        for name, text in fields.items()
+    }, tokenizer_identity
+
+
 ######
-def load_or_update_character_data_from_file(filepath: str, cursor: any, logging: any):
+async def load_or_update_character_data_from_file(
+    filepath: str, database: any, logging: any
+):
     try:
         chardata = load_character_data_from_file(filepath)
-        db.register_or_update_character_in_database(
-            chardata["name"],
-            chardata["filename"],
-            chardata["context"],
-            cursor,
-            chardata["example_conversation"],
-            chardata["greeting"],
+        stored_character = await database.retrieve_character_information_by_filename(
+            chardata["filename"]
         )
+        token_counts, tokenizer_identity = None, None
+        if (
+            stored_character
+            and stored_character[0]["file_hash"] == chardata["file_hash"]
+            and stored_character[0]["tokenizer_identity"] is not None
+            and stored_character[0]["tokenizer_identity"]
+            == await api.get_tokenizer_identity()
+        ):
+            # same file and tokenizer as last time, the stored counts still hold
+            token_counts = {
+                "persona": stored_character[0]["persona_token_count"],
+                "example_conversation": stored_character[0][
+                    "example_conversation_token_count"
+                ],
+                "greeting": stored_character[0]["greeting_token_count"],
+            }
+            tokenizer_identity = stored_character[0]["tokenizer_identity"]
+        else:
+            try:
+                token_counts, tokenizer_identity = await count_character_tokens(
+                    chardata
+                )
+            except Exception as e:
+                # without counts the prompt builder counts the fields itself, and they're retried on the next load
+                logging.warning(
+                    f"Couldn't count tokens for character {chardata['filename']}: {e}"
+                )
+
+        # committed on its own, so the writer isn't held while the next character is counted
+        async with database.transaction():
+            await database.register_or_update_character_in_database(
+                chardata["name"],
+                chardata["filename"],
+                chardata["context"],
+                chardata["example_conversation"],
+                chardata["greeting"],
+                token_counts,
+                chardata["file_hash"],
+                tokenizer_identity,
+            )
     except Exception as e:
         # logging goes here
         logging.error(f"Error loading or updating character: {e}")
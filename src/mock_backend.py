@@ -0,0 +1,233 @@
+from __future__ import annotations
+from typing import Optional, List
+import argparse
+import asyncio
+import hashlib
+import logging
+import random
+from aiohttp import web
+
+# a stand-in for text-generation-webui's api, for measuring the bot without a model loaded
+# run with python -m src.mock_backend, and point api_backends at it with the same url for streaming_url
+
+WORDS = "the a of and to in is it you that he was for on are with as I his they be at one have this from or had by hot word but what some we can out other were all there when up use your how said an each she which do their time if will way about many then them write would like so these her long make thing see him two has look more day could go come did number sound no most people my over know water than call first who may down side been now find".split()
+
+
+class MockBackend:
+    def __init__(
+        self,
+        token_latency: float = 0.02,
+        prompt_token_cost: float = 0.0005,
+        max_new_tokens: int = 50,
+        failure_rate: float = 0.0,
+        hang_rate: float = 0.0,
+        concurrency: int = 1,
+        prefix_cache: bool = False,
+        model_name: str = "mock-model",
+        seed: int = 0,
+    ):
+        self.token_latency = token_latency
+        self.prompt_token_cost = prompt_token_cost
+        self.max_new_tokens = max_new_tokens
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.prefix_cache = prefix_cache
+        self.model_name = model_name
+        self.random = random.Random(seed)
+        self.generation_lock = asyncio.Semaphore(concurrency)
+        self.stop_event = asyncio.Event()
+        self.last_prompt_tokens = []
+        self.stats = {
+            "generations": 0,
+            "token_count_requests": 0,
+            "counted_texts": 0,
+            "prompt_tokens": 0,
+            "processed_prompt_tokens": 0,
+            "generated_tokens": 0,
+            "failures": 0,
+            "hangs": 0,
+            "stops": 0,
+        }
+
+    @staticmethod
+    def tokenize(text: str):
+        return text.split()
+
+    def generated_words(self, prompt: str, max_new_tokens: int):
+        # the same prompt always gets the same reply
+        seed = int.from_bytes(
+            hashlib.sha256(prompt.encode("utf-8")).digest()[:8], "big"
+        )
+        reply_random = random.Random(seed)
+        return [reply_random.choice(WORDS) for _ in range(max_new_tokens)]
+
+    async def process_prompt(self, prompt: str):
+        prompt_tokens = self.tokenize(prompt)
+        cached_tokens = 0
+        if self.prefix_cache:
+            for cached_token, prompt_token in zip(
+                self.last_prompt_tokens, prompt_tokens
+            ):
+                if cached_token != prompt_token:
+                    break
+                cached_tokens += 1
+            self.last_prompt_tokens = prompt_tokens
+        self.stats["prompt_tokens"] += len(prompt_tokens)
+        self.stats["processed_prompt_tokens"] += len(prompt_tokens) - cached_tokens
+        await asyncio.sleep(
+            (len(prompt_tokens) - cached_tokens) * self.prompt_token_cost
+        )
+
+    async def maybe_fail(self):
+        roll = self.random.random()
+        if roll < self.failure_rate:
+            self.stats["failures"] += 1
+            raise web.HTTPInternalServerError(text="Injected failure")
+        if roll < self.failure_rate + self.hang_rate:
+            self.stats["hangs"] += 1
+            await asyncio.Event().wait()
+
+    async def generate_words(self, payload: dict):
+        prompt = payload.get("prompt", "")
+        max_new_tokens = payload.get("max_new_tokens") or self.max_new_tokens
+        stopping_strings = payload.get("stopping_strings") or []
+        self.stop_event.clear()
+        await self.process_prompt(prompt)
+        text = ""
+        for word in self.generated_words(prompt, max_new_tokens):
+            if self.stop_event.is_set():
+                break
+            await asyncio.sleep(self.token_latency)
+            chunk = f" {word}"
+            if any(stop in text + chunk for stop in stopping_strings):
+                break
+            text += chunk
+            self.stats["generated_tokens"] += 1
+            yield chunk
+
+    async def generate(self, request: web.Request):
+        payload = await request.json()
+        await self.maybe_fail()
+        async with self.generation_lock:
+            self.stats["generations"] += 1
+            text = "".join([chunk async for chunk in self.generate_words(payload)])
+        return web.json_response({"results": [{"text": text}]})
+
+    async def stream(self, request: web.Request):
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        payload = await websocket.receive_json()
+        await self.maybe_fail()
+        async with self.generation_lock:
+            self.stats["generations"] += 1
+            message_num = 0
+            async for chunk in self.generate_words(payload):
+                await websocket.send_json(
+                    {"event": "text_stream", "message_num": message_num, "text": chunk}
+                )
+                message_num += 1
+            await websocket.send_json(
+                {"event": "stream_end", "message_num": message_num}
+            )
+        await websocket.close()
+        return websocket
+
+    async def token_count(self, request: web.Request):
+        payload = await request.json()
+        self.stats["token_count_requests"] += 1
+        texts = (
+            payload["prompts"] if "prompts" in payload else [payload.get("prompt", "")]
+        )
+        self.stats["counted_texts"] += len(texts)
+        return web.json_response(
+            {"results": [{"tokens": len(self.tokenize(text))} for text in texts]}
+        )
+
+    async def model(self, request: web.Request):
+        return web.json_response({"result": self.model_name})
+
+    async def stop_stream(self, request: web.Request):
+        self.stats["stops"] += 1
+        self.stop_event.set()
+        return web.json_response({"results": "success"})
+
+    async def get_stats(self, request: web.Request):
+        return web.json_response(self.stats)
+
+    def create_app(self):
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/api/v1/generate", self.generate),
+                web.get("/api/v1/stream", self.stream),
+                web.post("/api/v1/token-count", self.token_count),
+                web.get("/api/v1/model", self.model),
+                web.post("/api/v1/stop-stream", self.stop_stream),
+                web.get("/mock/stats", self.get_stats),
+            ]
+        )
+        return app
+
+
+async def start_mock_backend(host: str = "127.0.0.1", port: int = 5000, **kwargs):
+    backend = MockBackend(**kwargs)
+    runner = web.AppRunner(backend.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, backend
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake text-generation-webui api")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--token-latency", type=float, default=0.02, help="seconds per generated token"
+    )
+    parser.add_argument(
+        "--prompt-token-cost",
+        type=float,
+        default=0.0005,
+        help="seconds per prompt token",
+    )
+    parser.add_argument("--max-new-tokens", type=int, default=50)
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="chance a generation errors"
+    )
+    parser.add_argument(
+        "--hang-rate", type=float, default=0.0, help="chance a generation never returns"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="generations run at the same time"
+    )
+    parser.add_argument(
+        "--prefix-cache",
+        action="store_true",
+        help="only charge for prompt tokens after the prefix shared with the last prompt",
+    )
+    parser.add_argument("--model-name", default="mock-model")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        runner, _ = await start_mock_backend(
+            args.host,
+            args.port,
+            token_latency=args.token_latency,
+            prompt_token_cost=args.prompt_token_cost,
+            max_new_tokens=args.max_new_tokens,
+            failure_rate=args.failure_rate,
+            hang_rate=args.hang_rate,
+            concurrency=args.concurrency,
+            prefix_cache=args.prefix_cache,
+            model_name=args.model_name,
+            seed=args.seed,
+        )
+        logging.info(f"Mock backend running on http://{args.host}:{args.port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
@@ -1,51 +1,191 @@
 from __future__ import annotations
 from typing import Optional, List
 from pathlib import Path
+import bisect
+import itertools
+import json
 import sqlite3
 from . import api
 import logging
 
+# per channel and character, where the history in the prompt starts and the last prompt sent
+stable_layouts = {}
+# per channel, the first message that made it into the latest prompt, older ones can be summarized
+history_starts = {}
+# rendered prompt parts that don't change between turns, per character, preset, scenarios and hash mode
+compiled_prompts = {}
+MAX_COMPILED_PROMPTS = 1024
+
+# which parts of the prompt get filled first (lower first) and how many tokens they can take
+# budgets under 1 are a fraction of the context length, None means as much as is left
+DEFAULT_SEGMENT_CONFIG = {
+    "persona": {"priority": 1, "budget": None},
+    "scenario": {"priority": 2, "budget": 0.25},
+    "summary": {"priority": 3, "budget": 0.15},
+    "history": {"priority": 4, "budget": None},
+    "examples": {"priority": 5, "budget": 0.25},
+}
+# a text is only partially included if at least this many tokens of it fit
+MIN_PARTIAL_SEGMENT_TOKENS = 16
+
 
 ######
 
 
-def check_token_and_add_to_prompt(
-    constructed_prompt: str,
-    added_text: str,
-    existing_token_count: Optional[int] = None,
-    added_text_token_count: Optional[int] = None,
-    context_length: Optional[int] = 2048,
-    append: Optional[bool] = True,
-):
-    existing_token_count = existing_token_count or api.count_tokens(constructed_prompt)
-    added_text_token_count = added_text_token_count or api.count_tokens(added_text)
+class PromptSegment:
+    def __init__(
+        self,
+        name: str,
+        text: str,
+        token_count: int,
+        priority: int = 0,
+        budget: Optional[int] = None,
+        trimmable: bool = True,
+    ):
+        self.name = name
+        self.text = text
+        self.token_count = token_count
+        self.priority = priority
+        self.budget = budget
+        self.trimmable = trimmable
 
-    token_count = existing_token_count + added_text_token_count
+    def parts(self):
+        return [self.text] if self.text else []
+
+    async def fit(self, token_allowance: int, counter: any):
+        if self.token_count <= token_allowance:
+            return self.token_count
+        if self.trimmable and token_allowance >= MIN_PARTIAL_SEGMENT_TOKENS:
+            self.text, self.token_count = await trim_text_to_token_budget(
+                self.text, self.token_count, token_allowance, counter
+            )
+        else:
+            self.text, self.token_count = "", 0
+        return self.token_count
+
+
+class HistorySegment(PromptSegment):
+    def __init__(
+        self,
+        header: str,
+        header_token_count: int,
+        messages: List[any],
+        prepared_messages: List[str],
+        message_token_counts: List[int],
+        priority: int = 0,
+        budget: Optional[int] = None,
+        stable_layout: Optional[dict] = None,
+        stable_layout_truncate_to: float = 0.6,
+        add_hashes_to_convo: bool = True,
+    ):
+        super().__init__(
+            "history",
+            header,
+            header_token_count + sum(message_token_counts),
+            priority,
+            budget,
+        )
+        self.header_token_count = header_token_count
+        self.messages = messages
+        self.prepared_messages = prepared_messages
+        self.message_token_counts = message_token_counts
+        self.stable_layout = stable_layout
+        self.stable_layout_truncate_to = stable_layout_truncate_to
+        self.add_hashes_to_convo = add_hashes_to_convo
+        self.first_message_index = 0
+        self.partial_message = ""
 
-    if token_count <= context_length:
+    def parts(self):
         return (
-            (constructed_prompt + added_text, token_count, True)
-            if append
-            else (added_text + constructed_prompt, token_count, True)
+            [self.text, self.partial_message]
+            + self.prepared_messages[self.first_message_index :]
+            if self.text
+            else []
         )
-    else:
-        return (constructed_prompt, existing_token_count, False)
 
+    def included_messages(self):
+        return self.messages[self.first_message_index :] if self.text else []
 
-def construct_prechat_prompt(character_name: str, character_context: str, config: dict):
-    preamble_prompt = config.get("preamble_prompt", "")
-    persona_prompt = config.get("persona_prompt", "## Persona")
+    def first_included_message_id(self):
+        included_messages = self.included_messages()
+        return included_messages[0].get("message_id") if included_messages else None
+
+    async def fit(self, token_allowance: int, counter: any):
+        message_allowance = token_allowance - self.header_token_count
+        if message_allowance < 0:
+            self.text, self.token_count = "", 0
+            return 0
+
+        if self.stable_layout is not None:
+            self.first_message_index = self.find_stable_start(message_allowance)
+        else:
+            self.first_message_index = len(
+                self.messages
+            ) - count_newest_messages_that_fit(
+                self.message_token_counts, message_allowance
+            )
+        self.token_count = self.header_token_count + sum(
+            self.message_token_counts[self.first_message_index :]
+        )
 
+        # rather than leave the space empty, keep the end of the next message that didn't fit
+        leftover = token_allowance - self.token_count
+        if (
+            self.stable_layout is None
+            and self.first_message_index > 0
+            and leftover >= MIN_PARTIAL_SEGMENT_TOKENS
+        ):
+            message = self.messages[self.first_message_index - 1]
+            prefix = "### " if self.add_hashes_to_convo else ""
+            message_start = f"\n{prefix}{message['author']}: ..."
+            message_start_token_count = await counter(message_start)
+            trimmed_text, trimmed_token_count = await trim_text_to_token_budget(
+                message["message_content"],
+                self.message_token_counts[self.first_message_index - 1],
+                leftover - message_start_token_count,
+                counter,
+                keep_end=True,
+            )
+            if trimmed_text:
+                self.partial_message = f"{message_start}{trimmed_text}"
+                self.token_count += message_start_token_count + trimmed_token_count
+        return self.token_count
+
+    def find_stable_start(self, message_allowance: int):
+        """Keeps the history starting at the same message between turns, cutting it back in one big chunk when it overflows"""
+        start = 0
+        if self.stable_layout.get("first_message_id") is not None:
+            start = bisect.bisect_left(
+                [message["message_id"] for message in self.messages],
+                self.stable_layout["first_message_id"],
+            )
+        if sum(self.message_token_counts[start:]) > message_allowance:
+            start = max(
+                start,
+                len(self.messages)
+                - count_newest_messages_that_fit(
+                    self.message_token_counts,
+                    int(message_allowance * self.stable_layout_truncate_to),
+                ),
+            )
+        self.stable_layout["first_message_id"] = (
+            self.messages[start]["message_id"] if start < len(self.messages) else None
+        )
+        return start
+
+
+def construct_preamble_prompt(character_name: str, config: dict):
+    preamble_prompt = config.get("preamble_prompt", "")
     if preamble_prompt:
         preamble_prompt = preamble_prompt.replace("{{user}}", "You").replace(
             "{{char}}", character_name
         )
+    return preamble_prompt
 
-    persona_prompt = f"{persona_prompt}\n{character_context}"
-
-    constructed_prompt = f"{preamble_prompt}\n{persona_prompt}"
 
-    return constructed_prompt
+def construct_persona_prompt(character_context: str, config: dict):
+    persona_prompt = config.get("persona_prompt", "## Persona")
+    return f"\n{persona_prompt}\n{character_context}"
 
 
 def prepare_message(name: str, message: str, add_hashes_to_conversation: bool = True):
@@ -53,98 +193,319 @@ def prepare_message(name: str, message: str, add_hashes_to_conversation: bool =
     return f"\n{prefix}{name}: {message}"
 
 
-def prepare_character_prompt(
+async def trim_text_to_token_budget(
+    text: str,
+    token_count: int,
+    token_budget: int,
+    counter: any,
+    keep_end: bool = False,
+):
+    """Shortens text at a line break or space until it fits the budget, keeping the start, or the end for chat messages"""
+    while text and token_count > token_budget:
+        if token_budget <= 0:
+            return "", 0
+        # guess where to cut from the length per token, then check
+        keep_length = int(len(text) * token_budget / token_count * 0.95)
+        if keep_end:
+            cut_index = text.find(" ", len(text) - keep_length)
+            text = text[cut_index + 1 :] if cut_index != -1 else ""
+        else:
+            cut_index = text.rfind("\n", 0, keep_length)
+            if cut_index < keep_length // 2:
+                cut_index = text.rfind(" ", 0, keep_length)
+            text = text[:cut_index] if cut_index > 0 else ""
+        token_count = await counter(text) if text else 0
+    return text, token_count
+
+
+def get_segment_settings(
+    segment_config: Optional[dict], name: str, context_length: int
+):
+    settings = {
+        **DEFAULT_SEGMENT_CONFIG.get(name, {}),
+        **((segment_config or {}).get(name) or {}),
+    }
+    budget = settings.get("budget")
+    if budget is not None and budget < 1:
+        budget = int(context_length * budget)
+    return settings.get("priority", 0), budget
+
+
+def invalidate_compiled_prompts(character_id: Optional[int] = None):
+    global compiled_prompts
+    if character_id is None:
+        compiled_prompts = {}
+    else:
+        compiled_prompts = {
+            key: compiled
+            for key, compiled in compiled_prompts.items()
+            if key[0] != character_id
+        }
+
+
+async def compile_static_prompt(
+    character, config, scenario: Optional[str] = "", add_hashes_to_convo: bool = True
+):
+    """Renders the parts of a character's prompt that don't change between turns and counts their tokens, reusing them until invalidated"""
+    tokenizer_identity = await api.get_tokenizer_identity()
+    key = (
+        character["id"],
+        json.dumps(config, sort_keys=True),
+        scenario,
+        character["scenario"],
+        add_hashes_to_convo,
+        tokenizer_identity,
+    )
+    if key in compiled_prompts:
+        return compiled_prompts[key]
+
+    prefix = "### " if add_hashes_to_convo else ""
+    total_scenario = "\n".join(
+        part for part in [scenario, character["scenario"]] if part
+    )
+    logging.debug(total_scenario)
+
+    examples_header = (
+        f"\n\n{config.get('example_conversation_prompt', '## Example conversation')}\n"
+    )
+    texts = {
+        "preamble": construct_preamble_prompt(character["name"], config),
+        "persona": construct_persona_prompt(character["persona"], config),
+        "examples": f"{examples_header}{character['example_conversation']}\n"
+        if character["example_conversation"]
+        else "",
+        "scenario": f"\n{config.get('scenario_prompt', '## Scenario')}\n{total_scenario}"
+        if total_scenario
+        else "",
+        "epilogue": f"\n{config.get('epilogue_prompt', '## Chat')}",
+        "reply": f"\n{prefix}{character['name']}:",
+        "message_separator": f"\n{prefix}",
+    }
+    # with the field counts stored when the character was loaded, only the headers around them need counting
+    stored_token_counts = {}
+    if (
+        tokenizer_identity is not None
+        and character["tokenizer_identity"] == tokenizer_identity
+    ):
+        if character["persona_token_count"] is not None:
+            stored_token_counts["persona"] = character["persona_token_count"]
+        if (
+            texts["examples"]
+            and character["example_conversation_token_count"] is not None
+        ):
+            stored_token_counts["examples"] = character[
+                "example_conversation_token_count"
+            ]
+    texts_to_count = {
+        **texts,
+        "persona": construct_persona_prompt("", config)
+        if "persona" in stored_token_counts
+        else texts["persona"],
+        "examples": f"{examples_header}\n"
+        if "examples" in stored_token_counts
+        else texts["examples"],
+    }
+    token_counts = await api.count_tokens_many([""] + list(texts_to_count.values()))
+    # counts can include special tokens like bos, which only appear once in the whole prompt
+    special_token_count = token_counts[0]
+    compiled = {
+        "texts": texts,
+        "token_counts": {
+            name: token_count - special_token_count + stored_token_counts.get(name, 0)
+            if texts[name]
+            else 0
+            for name, token_count in zip(texts_to_count, token_counts[1:])
+        },
+        "special_token_count": special_token_count,
+    }
+    logging.debug(compiled["token_counts"])
+
+    if len(compiled_prompts) >= MAX_COMPILED_PROMPTS:
+        compiled_prompts.clear()
+    compiled_prompts[key] = compiled
+    return compiled
+
+
+async def prepare_character_prompt(
     character,
     message_history,
     context_length,
     config,
     scenario: Optional[str] = "",
     add_hashes_to_convo: bool = True,
+    prompt_layout: str = "default",
+    channel_id: Optional[int] = None,
+    stable_layout_truncate_to: float = 0.6,
+    segment_config: Optional[dict] = None,
+    summary: Optional[str] = None,
 ):
     try:
-        prefix = "### " if add_hashes_to_convo else ""
-
-        constructed_prompt = construct_prechat_prompt(
-            character["name"], character["persona"], config
+        compiled = await compile_static_prompt(
+            character, config, scenario, add_hashes_to_convo
         )
+        texts = compiled["texts"]
+        static_token_counts = compiled["token_counts"]
+        special_token_count = compiled["special_token_count"]
 
-        character_scenario = (
-            f'\n{character["scenario"]}' if character["scenario"] else ""
-        )
+        async def count_without_special_tokens(text: str):
+            return await api.count_tokens(text) - special_token_count
+
+        message_history = [
+            message
+            for message in message_history
+            if not message["message_content"].isspace()
+        ]
+        prepared_messages = [
+            prepare_message(
+                message["author"], message["message_content"], add_hashes_to_convo
+            )
+            for message in message_history
+        ]
+        # stored counts are for "author: message", the prepared message adds a line break and maybe hashes,
+        # counts from another tokenizer are left out until counting.py redoes them
+        tokenizer_identity = await api.get_tokenizer_identity()
+        message_token_counts = [
+            message["token_count"]
+            - special_token_count
+            + static_token_counts["message_separator"]
+            if message["token_count"] is not None
+            and tokenizer_identity is not None
+            and message["tokenizer_identity"] == tokenizer_identity
+            else None
+            for message in message_history
+        ]
+        uncounted_indexes = [
+            index
+            for index, token_count in enumerate(message_token_counts)
+            if token_count is None
+        ]
+        if uncounted_indexes:
+            # count whatever isn't stored in one go, so the api is asked at most once per prompt
+            uncounted_message_token_counts = await api.count_tokens_many(
+                [prepared_messages[index] for index in uncounted_indexes]
+            )
+            for index, uncounted_token_count in zip(
+                uncounted_indexes, uncounted_message_token_counts
+            ):
+                message_token_counts[index] = (
+                    uncounted_token_count - special_token_count
+                )
 
-        total_scenario = scenario + character_scenario
-        logging.debug(total_scenario)
+        stable_layout = None
+        if prompt_layout == "stable" and channel_id is not None:
+            stable_layout = stable_layouts.setdefault((channel_id, character["id"]), {})
 
-        if scenario != "" or character["scenario"]:
-            constructed_end_prompt = f"{config.get('scenario_prompt', '## Scenario')}{total_scenario}\n{config.get('epilogue_prompt', '## Chat')}"
-            logging.debug(constructed_end_prompt)
-            token_count = api.count_tokens(
-                constructed_prompt
-                + f"\n{prefix}{character['name']}:"
-                + f"{config.get('scenario_prompt', '## Scenario')}\n{total_scenario}\n{config.get('epilogue_prompt', '## Chat')}"
+        segments = {}
+        for name in ["persona", "examples", "scenario"]:
+            segments[name] = PromptSegment(
+                name,
+                texts[name],
+                static_token_counts[name],
+                *get_segment_settings(segment_config, name, context_length),
             )
-            logging.debug(token_count)
-        else:
-            constructed_end_prompt = f"\n{config.get('epilogue_prompt', '## Chat')}"
-            token_count = api.count_tokens(
-                constructed_prompt
-                + config.get("epilogue_prompt", "## Chat")
-                + f"\n{prefix}{character['name']}:"
+        summary_text = (
+            f"\n{config.get('summary_prompt', '## Summary of earlier conversation')}\n{summary}"
+            if summary
+            else ""
+        )
+        segments["summary"] = PromptSegment(
+            "summary",
+            summary_text,
+            await count_without_special_tokens(summary_text) if summary_text else 0,
+            *get_segment_settings(segment_config, "summary", context_length),
+        )
+        segments["history"] = HistorySegment(
+            texts["epilogue"],
+            static_token_counts["epilogue"],
+            message_history,
+            prepared_messages,
+            message_token_counts,
+            *get_segment_settings(segment_config, "history", context_length),
+            stable_layout=stable_layout,
+            stable_layout_truncate_to=stable_layout_truncate_to,
+            add_hashes_to_convo=add_hashes_to_convo,
+        )
+
+        # the preamble and the cue for the character to reply always go in
+        token_allowance = (
+            context_length
+            - special_token_count
+            - static_token_counts["preamble"]
+            - static_token_counts["reply"]
+        )
+        # for the stable layout, everything before the history is settled first so it doesn't depend on the history
+        for segment in sorted(
+            segments.values(),
+            key=lambda segment: (
+                stable_layout is not None and segment.name == "history",
+                segment.priority,
+            ),
+        ):
+            segment_allowance = (
+                token_allowance
+                if segment.budget is None
+                else min(segment.budget, token_allowance)
+            )
+            token_allowance -= await segment.fit(
+                max(segment_allowance, 0), count_without_special_tokens
             )
 
-        message_prompt = ""
-
-        authors = set()
-        x = 0
-        while token_count < context_length and x < len(message_history) + 1:
-            if x < len(message_history):
-                current_message = message_history[x]
-
-                if not current_message["message_content"].isspace():
-                    prepared_message = prepare_message(
-                        current_message["author"],
-                        current_message["message_content"],
-                        add_hashes_to_convo,
-                    )
-                    (
-                        message_prompt,
-                        token_count,
-                        added_message,
-                    ) = check_token_and_add_to_prompt(
-                        message_prompt,
-                        f"{prepared_message}",
-                        token_count,
-                        None,
-                        context_length,
-                        True,
-                    )
-                    if added_message:
-                        authors.add(f"\n{current_message['author']}")
-
-            elif x == len(message_history) and character["example_conversation"]:
-                example_conversation = (
-                    f"\n\n{config.get('example_conversation_prompt', '## Example conversation')}\n"
-                    + character["example_conversation"]
-                    + "\n"
-                )
+        constructed_prompt = "".join(
+            [texts["preamble"]]
+            + segments["persona"].parts()
+            + segments["examples"].parts()
+            + segments["scenario"].parts()
+            + segments["summary"].parts()
+            + segments["history"].parts()
+            + [texts["reply"]]
+        )
 
-                token_count += api.count_tokens(example_conversation)
-                if token_count < context_length:
-                    message_prompt = (
-                        example_conversation + constructed_end_prompt + message_prompt
-                    )
-                # else: break out of loop
-            elif x == len(message_history):
-                message_prompt = constructed_end_prompt + message_prompt
+        if channel_id is not None:
+            history_start = segments["history"].first_included_message_id()
+            if history_start is not None:
+                history_starts[channel_id] = history_start
 
-            x = x + 1
+        if stable_layout is not None:
+            log_prefix_overlap(
+                stable_layout, (channel_id, character["id"]), constructed_prompt
+            )
 
-        constructed_prompt += message_prompt
-        constructed_prompt += f"\n{prefix}{character['name']}:"
-        stopping_strings = list(authors)
+        stopping_strings = list(
+            set(
+                f"\n{message['author']}"
+                for message in segments["history"].included_messages()
+            )
+        )
         return (
             constructed_prompt,
             stopping_strings,
         )
     except Exception as e:
         raise Exception(f"Error in prompt creation: {e}")
+
+
+def count_newest_messages_that_fit(token_counts: List[int], token_budget: int):
+    newest_first_totals = list(itertools.accumulate(reversed(token_counts)))
+    return bisect.bisect_right(newest_first_totals, token_budget)
+
+
+def common_prefix_length(first: str, second: str):
+    length = 0
+    for first_character, second_character in zip(first, second):
+        if first_character != second_character:
+            break
+        length += 1
+    return length
+
+
+def log_prefix_overlap(stable_layout: dict, layout_key: tuple, constructed_prompt: str):
+    last_prompt = stable_layout.get("last_prompt", "")
+    prefix_overlap = (
+        common_prefix_length(last_prompt, constructed_prompt) / len(constructed_prompt)
+        if last_prompt
+        else 0.0
+    )
+    stable_layout["last_prompt"] = constructed_prompt
+    logging.info(
+        f"Prompt prefix overlap with previous turn for (channel, character) {layout_key}: {prefix_overlap:.0%}"
+    )
@@ -3,11 +3,13 @@ import asyncio
 import random
 import logging
 import logging.handlers
+import time
 import discord
+from collections import deque
 from discord import app_commands
 from discord.ext import commands
 from typing import List, Optional
-from . import api, db, loading, prompting
+from . import api, conversation, loading, prompting
 
 
 async def send_long_message(channel, message_text):
@@ -28,6 +30,162 @@ async def send_long_message(channel, message_text):
         await send_long_message(channel, message_text[closing_codeblock_index + 3 :])
 
 
+def find_message_split_index(message_text: str, start: int, limit: int = 2000):
+    end = start + limit
+    split_index = message_text.rfind("\n", start + 1, end)
+    if split_index == -1:
+        split_index = message_text.rfind(" ", start + 1, end)
+    return split_index if split_index != -1 else end
+
+
+async def send_streamed_message(
+    channel, message_prefix: str, text_stream: any, edit_interval: float = 1.5
+):
+    """Sends the first generated text straight away, then edits the message as more text streams in, starting a new message at discord's character limit"""
+    loop = asyncio.get_running_loop()
+    response = ""
+    current_message = None
+    current_start = 0
+    shown_text = ""
+    last_edit_time = 0.0
+
+    async for chunk in text_stream:
+        response += chunk
+        if response.isspace() or not response:
+            continue
+        message_text = f"{message_prefix}{response.lstrip()}"
+
+        while len(message_text) - current_start > 2000:
+            split_index = find_message_split_index(message_text, current_start)
+            finished_text = message_text[current_start:split_index]
+            if current_message:
+                await current_message.edit(content=finished_text)
+            else:
+                await channel.send(finished_text)
+            current_message = None
+            current_start = split_index
+            while current_start < len(message_text) and message_text[current_start] in (
+                "\n",
+                " ",
+            ):
+                current_start += 1
+
+        current_text = message_text[current_start:]
+        if not current_text or current_text.isspace():
+            continue
+        if current_message is None:
+            current_message = await channel.send(current_text)
+            shown_text = current_text
+            last_edit_time = loop.time()
+        elif (
+            current_text != shown_text and loop.time() - last_edit_time >= edit_interval
+        ):
+            await current_message.edit(content=current_text)
+            shown_text = current_text
+            last_edit_time = loop.time()
+
+    if current_message:
+        current_text = f"{message_prefix}{response.strip()}"[current_start:]
+        if current_text != shown_text:
+            await current_message.edit(content=current_text)
+    return response.strip()
+
+
+class RequestDispatcher:
+    def __init__(self, wait_time_samples: int = 1000):
+        self.requests = deque()
+        self.has_requests = asyncio.Event()
+        self.accepting = True
+        self.task = None
+        # background jobs sharing the database with the requests, by name
+        self.workers = {}
+        self.attending = None
+        self.last_active = time.monotonic()
+        # seconds each recent request waited before it was attended
+        self.wait_times = deque(maxlen=wait_time_samples)
+        self.attended = 0
+
+    def put(self, request: QueueRequest):
+        if not self.accepting:
+            logging.warning(f"Shutting down, dropped {type(request).__name__}")
+            return False
+        request.queued_at = time.monotonic()
+        self.requests.append(request)
+        self.has_requests.set()
+        return True
+
+    def count_requests_from_author(self, author_id: int):
+        return sum(request.author_id == author_id for request in self.requests)
+
+    def is_idle(self, idle_seconds: float = 0):
+        return (
+            not self.requests
+            and self.attending is None
+            and time.monotonic() - self.last_active >= idle_seconds
+        )
+
+    def start(self, database: any, config: any, client: any):
+        # on_ready runs again after a reconnect, there's only ever one loop attending requests
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run(database, config, client))
+
+    def start_worker(self, name: str, function: any, *args):
+        # the same goes for the background jobs, two of them would race on the same rows
+        worker = self.workers.get(name)
+        if worker is None or worker.done():
+            self.workers[name] = asyncio.create_task(function(*args))
+
+    async def run(self, database: any, config: any, client: any):
+        while self.requests or self.accepting:
+            if not self.requests:
+                self.has_requests.clear()
+                await self.has_requests.wait()
+                continue
+            request = self.requests.popleft()
+            request.wait_time = time.monotonic() - request.queued_at
+            self.wait_times.append(request.wait_time)
+            logging.debug(
+                f"Attending {type(request).__name__} after {request.wait_time:.3f}s in the queue"
+            )
+            self.attending = request
+            try:
+                # whatever it leaves uncommitted is committed when it's done, or rolled back if it fails
+                async with database.transaction():
+                    await request.attend_request(database, config, client)
+            except Exception as e:
+                logging.error(f"Error attending {type(request).__name__}: {e}")
+            finally:
+                self.attending = None
+                self.last_active = time.monotonic()
+                self.attended += 1
+
+    async def drain(self, timeout: Optional[float] = None):
+        self.accepting = False
+        self.has_requests.set()
+        if self.task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.task), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(
+                    f"Gave up on {len(self.requests)} queued requests after {timeout}s"
+                )
+                self.task.cancel()
+        # nothing else should be writing once the requests are seen to
+        for worker in self.workers.values():
+            worker.cancel()
+        self.workers = {}
+
+    def stats(self):
+        wait_times = sorted(self.wait_times)
+        return {
+            "queued": len(self.requests),
+            "attended": self.attended,
+            "mean_wait": sum(wait_times) / len(wait_times) if wait_times else None,
+            "p95_wait": wait_times[int(len(wait_times) * 0.95)] if wait_times else None,
+            "max_wait": wait_times[-1] if wait_times else None,
+        }
+
+
 class QueueRequest:
     def __init__(self, channel_id: int, author_id: int):
         self.channel_id = channel_id
@@ -36,7 +194,7 @@ class QueueRequest:
     async def enqueue_request():
         ...
 
-    async def attend_request(self, cursor: any, conn: any, config: any, client: any):
+    async def attend_request(self, database: any, config: any, client: any):
         ...
 
 
@@ -54,7 +212,7 @@ class GenericGenerationRequest:
         self.should_send_message = should_send_message
         self.previous_message_if_edit = previous_message_if_edit
 
-    async def attend_request(self, cursor: any, conn: any, config: any, client: any):
+    async def attend_request(self, database: any, config: any, client: any):
         message = self.message_content.replace("\\n", "\n")
         params = config.get("generate_params", {})
         params["auto_max_new_tokens"] = True
@@ -86,14 +244,14 @@ class GenericDatabaseRequest(QueueRequest):
         self.success_embed = success_embed
         self.failure_embed = failure_embed
 
-    async def attend_request(self, cursor: any, conn: any, config: any, client: any):
+    async def attend_request(self, database: any, config: any, client: any):
         channel = await client.fetch_channel(int(self.channel_id))
         try:
-            self.database_function(**self.func_kwargs, cursor=cursor)
-            conn.commit()
+            await database.call(self.database_function, **self.func_kwargs)
+            await database.commit()
             await channel.send(embed=discord.Embed().from_dict(self.success_embed))
         except Exception as e:
-            conn.rollback()
+            await database.rollback()
             self.failure_embed["description"] = self.failure_embed[
                 "description"
             ].replace("{{e}}", e)
@@ -125,32 +283,32 @@ class ClearRequest(QueueRequest):
         else:
             raise Exception("Clear request sent without clearing anything.")
 
-    async def attend_request(self, cursor: any, conn: any, config: any, client: any):
+    async def attend_request(self, database: any, config: any, client: any):
         channel = await client.fetch_channel(int(self.channel_id))
         try:
             things_reset = []
 
             if self.clear_history:
-                db.reset_memory_for_current_channel(self.channel_id, cursor)
+                await database.reset_memory_for_current_channel(self.channel_id)
                 things_reset.append(
                     "Character message history for current channel cleared"
                 )
 
             if self.clear_activated_characters:
-                db.deactivate_all(self.channel_id, cursor)
+                await database.deactivate_all(self.channel_id)
                 things_reset.append("All characters in current channel deactivated")
 
             if self.clear_channel_scenario:
-                db.add_scenario_to_current_room(self.channel_id, None, cursor)
+                await database.add_scenario_to_current_room(self.channel_id, None)
                 things_reset.append("Channel scenario for current channel cleared")
 
             if self.clear_character_scenarios and not self.clear_activated_characters:
-                db.reset_all_active_character_scenarios(self.channel_id, cursor)
+                await database.reset_all_active_character_scenarios(self.channel_id)
                 things_reset.append(
                     "All character scenarios for current channel cleared"
                 )
 
-            conn.commit()
+            await database.commit()
 
             success_embed_description = "\n• " + "\n• ".join(things_reset)
 
@@ -192,12 +350,12 @@ class ActivateRequest(QueueRequest):
         self.scenario = scenario
         self.negative_prompt = negative_prompt
 
-    async def attend_request(self, cursor: any, conn: any, config: any, client: any):
+    async def attend_request(self, database: any, config: any, client: any):
         channel = await client.fetch_channel(int(self.channel_id))
         try:
             if config.get("max_characters_in_group_chat"):
-                character_data = db.get_active_character_data_per_room(
-                    self.channel_id, cursor
+                character_data = await database.get_active_character_data_per_room(
+                    self.channel_id
                 )
                 character_names = list(i["name"] for i in character_data)
                 if (
@@ -208,18 +366,17 @@ class ActivateRequest(QueueRequest):
                         f"Cannot exceed configured limit of active characters per channel set at {config.get('max_characters_in_group_chat')}."
                     )
 
-            db.set_active_character_per_room(
+            await database.set_active_character_per_room(
                 self.character_name,
                 self.channel_id,
-                cursor,
                 True,
                 self.scenario,
                 self.negative_prompt,
             )
-            conn.commit()
+            await database.commit()
             logging.debug("character activated")
-            character_info = db.retrieve_character_information_by_filename(
-                self.character_name, cursor
+            character_info = await database.retrieve_character_information_by_filename(
+                self.character_name
             )
             logging.debug(character_info)
             # conn.close()
@@ -243,17 +400,15 @@ class ActivateRequest(QueueRequest):
                     channel,
                     f"**{character_info[0]['name']}**: {character_info[0]['greeting']}",
                 )
-                db.save_message(
+                await database.save_message(
                     character_info[0]["greeting"],
                     character_info[0]["name"],
                     self.channel_id,
                     None,
-                    cursor,
-                    True,
                 )
-            conn.commit()
+            await database.commit()
         except Exception as e:
-            conn.rollback()
+            await database.rollback()
             embed_message = {
                 "title": f"Failed to activate {self.character_name}.",
                 "description": f"Error: {e}",
@@ -279,27 +434,26 @@ class ChatGenerationRequest(QueueRequest):
         self.message_id = message_id
         self.is_continuation = is_continuation
 
-    async def attend_request(self, cursor: any, conn: any, config: any, client: any):
+    async def attend_request(self, database: any, config: any, client: any):
         # try:
         channel = await client.fetch_channel(int(self.channel_id))
         prompt_config = config.get("prompt_config", {})
         if not self.is_continuation:
-            db.save_user_message_to_history(
+            await database.save_user_message_to_history(
                 self.author_id,
                 self.channel_id,
                 self.message_id,
                 self.message_content,
                 self.author_display_name,
-                cursor,
-                conn,
             )
-            conn.commit()
 
-        chardata = db.get_active_character_data_per_room(self.channel_id, cursor)
+        chardata = await database.get_active_character_data_per_room(self.channel_id)
         if len(chardata) < 1:  # activate character if there isn't any
-            db.set_active_character_per_room(
-                config.get("default_character"), self.channel_id, cursor, True, None
+            await database.set_active_character_per_room(
+                config.get("default_character"), self.channel_id, True, None
             )
+            # committed before generating, so nothing else has to wait on the writer meanwhile
+            await database.commit()
             await channel.send(
                 embed=discord.Embed().from_dict(
                     {
@@ -308,7 +462,9 @@ class ChatGenerationRequest(QueueRequest):
                     }
                 )
             )
-            chardata = db.get_active_character_data_per_room(self.channel_id, cursor)
+            chardata = await database.get_active_character_data_per_room(
+                self.channel_id
+            )
 
         if (not self.is_continuation and len(chardata) > 1) or (
             self.is_continuation and len(chardata) > 2
@@ -341,22 +497,32 @@ class ChatGenerationRequest(QueueRequest):
             else:  # insert chance for character to not talk here? this is also if there's only one character
                 talking_characters.append(character)
 
-        scenario = db.get_scenario_from_current_room(self.channel_id, cursor) or ""
+        scenario = await database.get_scenario_from_current_room(self.channel_id) or ""
+        summary = (
+            await database.get_summary_for_channel(self.channel_id)
+            if config.get("summarize_evicted_history")
+            else None
+        )
         for character in talking_characters:
             async with channel.typing():
-                message_history = db.get_message_history_from_channel(
-                    self.channel_id, cursor
-                )
+                message_history = (
+                    await conversation.get_window(self.channel_id, database)
+                ).messages
                 (
                     constructed_prompt,
                     additional_stopping_strings,
-                ) = prompting.prepare_character_prompt(
+                ) = await prompting.prepare_character_prompt(
                     character,
                     message_history,
                     config.get("context_length", 2046),
                     prompt_config,
                     scenario,
                     config.get("add_hashes_to_conversation", False),
+                    config.get("prompt_layout", "default"),
+                    self.channel_id,
+                    config.get("stable_layout_truncate_to", 0.6),
+                    config.get("prompt_segments"),
+                    summary["summary"] if summary else None,
                 )
                 stopping_strings = list(
                     set(additional_stopping_strings + prelim_stopping_strings)
@@ -370,25 +536,32 @@ class ChatGenerationRequest(QueueRequest):
                 params["stopping_strings"] = stopping_strings
                 logging.debug(params)
 
-                response = await api.generate_text(
-                    constructed_prompt,
-                    params,
-                )
-                response = response.strip()
-                logging.info(f"Reply generated: {response}")
-                if not response.isspace():  # if something was generated
-                    await send_long_message(
-                        channel, f"**{character['name']}**: {response}"
+                if config.get("stream_responses"):
+                    response = await send_streamed_message(
+                        channel,
+                        f"**{character['name']}**: ",
+                        api.stream_text(constructed_prompt, params),
+                        config.get("stream_edit_interval", 1.5),
                     )
-                    db.save_message(
+                else:
+                    response = await api.generate_text(
+                        constructed_prompt,
+                        params,
+                    )
+                    response = response.strip()
+                logging.info(f"Reply generated: {response}")
+                if response and not response.isspace():  # if something was generated
+                    if not config.get("stream_responses"):
+                        await send_long_message(
+                            channel, f"**{character['name']}**: {response}"
+                        )
+                    await database.save_message(
                         response,
                         character["name"],
                         self.channel_id,
                         None,
-                        cursor,
-                        True,
                     )
-                conn.commit()
+                await database.commit()
 
         # except Exception as e:
         #     raise Exception(f"Generation request error: {e}")
@@ -408,7 +581,7 @@ class SaveAndSendMessageRequest(QueueRequest):
         self.message_content = message_content
         self.display_author = display_author
 
-    async def attend_request(self, cursor: any, conn: any, config: any, client: any):
+    async def attend_request(self, database: any, config: any, client: any):
         channel = await client.fetch_channel(int(self.channel_id))
         async with channel.typing():
             message_to_send = (
@@ -420,12 +593,10 @@ class SaveAndSendMessageRequest(QueueRequest):
                 channel,
                 f"{message_to_send}",
             )
-            db.save_message(
+            await database.save_message(
                 self.message_content,
                 self.message_author,
                 self.channel_id,
                 None,
-                cursor,
-                True,
             )
-            conn.commit()
+            await database.commit()
@@ -0,0 +1,219 @@
+from __future__ import annotations
+from typing import Optional
+import re
+import sqlite3
+
+# the queries in db.py are written for sqlite, each engine here opens connections
+# whose cursors take them as they are, database.py runs db.py on whichever one config.yaml picks
+
+# write ahead logging lets reads carry on during a write, and NORMAL only syncs to disk at checkpoints
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -20000,  # in KiB when negative
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+
+class SQLiteStorage:
+    # whether reads can go to connections of their own
+    supports_readers = True
+    # whether old messages can be moved to an attached archive database
+    supports_archive = True
+    # whether other bot processes can be using the database at the same time
+    shared = False
+
+    def __init__(self, filepath: str = "bot.db", pragmas: Optional[dict] = None):
+        self.filepath = filepath
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+
+    def connect(self, read_only: bool = False):
+        if read_only:
+            conn = sqlite3.connect(f"file:{self.filepath}?mode=ro", uri=True)
+        else:
+            conn = sqlite3.connect(self.filepath)
+        conn.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items():
+            # the journal mode is the writer's to set, it sticks to the file
+            if not (read_only and pragma == "journal_mode"):
+                conn.execute(f"""PRAGMA {pragma} = {value}""")
+        return conn
+
+    def describe(self, conn: any):
+        journal_mode = conn.execute("""PRAGMA journal_mode""").fetchone()[0]
+        return f"{self.filepath} in {journal_mode} mode"
+
+
+class MemoryStorage(SQLiteStorage):
+    # an in-memory database only exists on the connection that made it
+    supports_readers = False
+    supports_archive = False
+
+    def __init__(self, pragmas: Optional[dict] = None):
+        super().__init__(":memory:", pragmas)
+
+    def describe(self, conn: any):
+        return "in memory"
+
+
+class Row(tuple):
+    def __new__(cls, names: list, values: tuple):
+        row = super().__new__(cls, values)
+        row.names = names
+        return row
+
+    def __getitem__(self, key: any):
+        if isinstance(key, str):
+            key = self.names.index(key)
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self.names)
+
+
+def row_factory(cursor: any):
+    names = [column.name for column in cursor.description or []]
+    return lambda values: Row(names, values)
+
+
+def translate_query(sql: str):
+    """Rewrites a query from db.py for postgres, returns None for ones postgres has no use for"""
+    statement = sql.strip()
+    match = re.fullmatch(r"PRAGMA user_version\s*(?:=\s*(\d+))?", statement, re.I)
+    if match:
+        # postgres has no user_version, the schema version is kept in a table of its own
+        if match.group(1) is None:
+            return """SELECT coalesce(max(version), 0) FROM schema_version"""
+        return f"""INSERT INTO schema_version (version) VALUES ({match.group(1)})"""
+    match = re.fullmatch(r"PRAGMA table_info\((\w+)\)", statement, re.I)
+    if match:
+        return f"""SELECT column_name AS name FROM information_schema.columns WHERE table_name = '{match.group(1)}'"""
+    if re.match(r"(PRAGMA|VACUUM)\b", statement, re.I):
+        return None
+    if re.match(r"(CREATE|ALTER) TABLE", statement, re.I):
+        statement = re.sub(
+            r"\bINTEGER PRIMARY KEY\b",
+            "BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY",
+            statement,
+            flags=re.I,
+        )
+        # discord ids don't fit in a postgres integer
+        statement = re.sub(r"\b(INTEGER|int)\b", "BIGINT", statement, flags=re.I)
+        statement = re.sub(r"\bDATETIME\b", "TIMESTAMP", statement, flags=re.I)
+        # the time of the insert, not of the start of its transaction, so messages sort the same by time as by id
+        statement = re.sub(
+            r"\bDEFAULT CURRENT_TIMESTAMP\b",
+            "DEFAULT clock_timestamp()",
+            statement,
+            flags=re.I,
+        )
+    return statement.replace("%", "%%").replace("?", "%s")
+
+
+class PostgresCursor:
+    def __init__(self, connection: PostgresConnection, cursor: any):
+        self.connection = connection
+        self.cursor = cursor
+        self.skipped = False
+
+    def execute(self, sql: str, parameters: tuple = ()):
+        query = translate_query(sql)
+        self.skipped = query is None
+        if not self.skipped:
+            self.cursor.execute(query, tuple(parameters))
+        return self
+
+    def executemany(self, sql: str, parameters: list):
+        self.skipped = False
+        self.cursor.executemany(
+            translate_query(sql), [tuple(row) for row in parameters]
+        )
+        return self
+
+    def fetchone(self):
+        if self.skipped or self.cursor.description is None:
+            return None
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        if self.skipped or self.cursor.description is None:
+            return []
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    @property
+    def rowcount(self):
+        return -1 if self.skipped else self.cursor.rowcount
+
+
+class PostgresConnection:
+    def __init__(self, conn: any):
+        self.conn = conn
+
+    def cursor(self):
+        return PostgresCursor(self, self.conn.cursor())
+
+    def execute(self, sql: str, parameters: tuple = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+class PostgresStorage:
+    supports_readers = True
+    supports_archive = False
+    shared = True
+
+    def __init__(self, dsn: str):
+        if not dsn:
+            raise Exception("The postgres database engine needs database_dsn set")
+        self.dsn = dsn
+
+    def connect(self, read_only: bool = False):
+        try:
+            import psycopg
+        except ImportError:
+            raise Exception(
+                "The postgres database engine needs psycopg, install it with pip install psycopg[binary]"
+            )
+
+        # readers don't keep a transaction open between queries, so each one sees the latest commits
+        conn = psycopg.connect(self.dsn, autocommit=read_only, row_factory=row_factory)
+        if read_only:
+            conn.execute("""SET default_transaction_read_only = on""")
+        else:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)"""
+            )
+            conn.commit()
+        return PostgresConnection(conn)
+
+    def describe(self, conn: PostgresConnection):
+        info = conn.conn.info
+        return f"postgres database {info.dbname} on {info.host}"
+
+
+def create_storage(
+    engine: Optional[str] = "sqlite",
+    filepath: Optional[str] = "bot.db",
+    pragmas: Optional[dict] = None,
+    dsn: Optional[str] = None,
+):
+    engine = engine or "sqlite"
+    if engine == "memory" or (engine == "sqlite" and filepath == ":memory:"):
+        return MemoryStorage(pragmas)
+    if engine == "sqlite":
+        return SQLiteStorage(filepath or "bot.db", pragmas)
+    if engine == "postgres":
+        return PostgresStorage(dsn)
+    raise Exception(f"Unknown database engine {engine}, use sqlite, memory or postgres")
@@ -0,0 +1,84 @@
+from __future__ import annotations
+from typing import Optional
+import asyncio
+import logging
+from . import api, prompting
+
+SUMMARY_INSTRUCTION = "## Instruction:\nWrite a short summary of the conversation below, keeping the names, important events and anything the characters would need to remember later. Write only the summary."
+
+
+def construct_summary_prompt(previous_summary: Optional[str], messages: list):
+    conversation = "".join(
+        prompting.prepare_message(message["author"], message["message_content"], False)
+        for message in messages
+    )
+    previous_summary_prompt = (
+        f"\n## Summary of what happened before:\n{previous_summary}"
+        if previous_summary
+        else ""
+    )
+    return f"{SUMMARY_INSTRUCTION}{previous_summary_prompt}\n## Conversation:{conversation}\n## Summary:\n"
+
+
+async def summarize_channel(channel_id: int, database: any, config: dict):
+    history_start = prompting.history_starts.get(channel_id)
+    if history_start is None:
+        return False
+
+    existing_summary = await database.get_summary_for_channel(channel_id)
+    previous_summary, last_summarized_message_id = (
+        (existing_summary["summary"], existing_summary["last_message_id"])
+        if existing_summary
+        else (None, None)
+    )
+    messages = await database.get_unsummarized_messages_from_channel(
+        channel_id,
+        last_summarized_message_id,
+        history_start,
+        config.get("summary_batch_size", 30),
+    )
+    # leave room in the context for the instruction, the old summary and the new one
+    token_budget = config.get("context_length", 2048) // 2
+    messages_to_summarize = []
+    for message in messages:
+        token_budget -= message["token_count"] or len(message["message_content"]) // 4
+        if token_budget < 0 and messages_to_summarize:
+            break
+        messages_to_summarize.append(message)
+    if not messages_to_summarize:
+        prompting.history_starts.pop(channel_id, None)
+        return False
+
+    params = {
+        **config.get("generate_params", {}),
+        "max_new_tokens": config.get("summary_max_tokens", 200),
+        "auto_max_new_tokens": False,
+        "stopping_strings": ["\n##", "\n#", "</s>"],
+    }
+    summary = await api.generate_text(
+        construct_summary_prompt(previous_summary, messages_to_summarize), params
+    )
+    summary = (summary or "").strip()
+    if not summary:
+        return False
+
+    async with database.transaction():
+        await database.save_summary_for_channel(
+            channel_id, summary, messages_to_summarize[-1]["message_id"]
+        )
+    logging.info(
+        f"Summarized {len(messages_to_summarize)} older messages for {channel_id}"
+    )
+    return True
+
+
+async def run_summarizer(is_idle: any, database: any, config: dict):
+    while True:
+        await asyncio.sleep(config.get("summary_idle_seconds", 60) / 2)
+        for channel_id in list(prompting.history_starts):
+            if not is_idle():
+                break
+            try:
+                await summarize_channel(channel_id, database, config)
+            except Exception as e:
+                logging.error(f"Error summarizing history for {channel_id}: {e}")
@@ -0,0 +1,112 @@
+from __future__ import annotations
+from typing import Optional, List
+from pathlib import Path
+import asyncio
+import argparse
+import glob
+import hashlib
+import logging
+import os
+from . import api, loading
+
+# local tokenizer loaded from disk, if none is configured then tokens are counted by the api
+encode = None
+tokenizer_identity = None
+
+
+def load_tokenizer(filepath: Optional[str], add_special_tokens: bool = True):
+    global encode, tokenizer_identity
+    encode = None
+    tokenizer_identity = None
+    if not filepath:
+        return False
+    if not os.path.exists(filepath):
+        logging.error(
+            f"Tokenizer file not found at {filepath}, counting tokens with the api"
+        )
+        return False
+
+    try:
+        if filepath.endswith(".model"):
+            import sentencepiece
+
+            processor = sentencepiece.SentencePieceProcessor(model_file=filepath)
+            encode = lambda text: processor.encode(text, add_bos=add_special_tokens)
+        else:
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_file(filepath)
+            encode = lambda text: tokenizer.encode(
+                text, add_special_tokens=add_special_tokens
+            ).ids
+    except Exception as e:
+        logging.error(
+            f"Could not load tokenizer at {filepath}, counting tokens with the api: {e}"
+        )
+        return False
+
+    file_hash = hashlib.sha256(Path(filepath).read_bytes()).hexdigest()[:16]
+    tokenizer_identity = f"local:{file_hash}:{int(add_special_tokens)}"
+    logging.info(f"Loaded tokenizer from {filepath}")
+    return True
+
+
+def is_loaded():
+    return encode is not None
+
+
+def count_tokens(text: str):
+    return len(encode(text))
+
+
+def load_sample_corpus(directories: List[str]):
+    corpus = []
+    for directory in directories:
+        for filepath in glob.glob(os.path.join(directory, "*.yaml")) + glob.glob(
+            os.path.join(directory, "*.json")
+        ):
+            data = loading.get_dict_from_filepath(filepath) or {}
+            for value in data.values():
+                if isinstance(value, str) and value.strip():
+                    corpus += [part for part in value.split("\n\n") if part.strip()]
+    return corpus
+
+
+async def compare_local_and_remote_counts(corpus: List[str]):
+    mismatches = []
+    for text in corpus:
+        local_count = count_tokens(text)
+        remote_count = await api.count_tokens_remotely(text)
+        if local_count != remote_count:
+            mismatches.append((text, local_count, remote_count))
+    await api.close_session()
+    return mismatches
+
+
+if __name__ == "__main__":
+    # python -m src.tokenizing, checks the configured tokenizer file against the api
+    parser = argparse.ArgumentParser(
+        description="Compare local tokenizer counts against the api's token counts"
+    )
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--tokenizer", default=None, help="overrides tokenizer_path")
+    parser.add_argument(
+        "--corpus", nargs="*", default=["characters", "configs"], help="directories"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    _, config = loading.load_config(args.config)
+    api.configure(config)
+    if not load_tokenizer(
+        args.tokenizer or config.get("tokenizer_path"),
+        config.get("tokenizer_add_special_tokens", True),
+    ):
+        raise SystemExit("No tokenizer loaded, set tokenizer_path or pass --tokenizer")
+
+    corpus = load_sample_corpus(args.corpus)
+    mismatches = asyncio.run(compare_local_and_remote_counts(corpus))
+    for text, local_count, remote_count in mismatches:
+        print(f"local {local_count} != remote {remote_count}: {text[:60]!r}")
+    print(f"{len(corpus) - len(mismatches)}/{len(corpus)} samples matched")
+    raise SystemExit(1 if mismatches else 0)